@@ -11,10 +11,15 @@ http://people.revoledu.com/kardi/
 (c) 2014-2022 Kardi Teknomo
 Available in https://github.com/teknomo/IdealFlowNetwork
 '''
+import warnings
 import numpy as np
 from fractions import Fraction
 from math import gcd
 from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.sparse import linalg as splinalg
+from scipy import optimize
+from concurrent.futures import ThreadPoolExecutor
 
 
 def lcm(a, b):
@@ -27,7 +32,12 @@ def lcm(a, b):
 def hadamardDivision(A, B):
     """
     return A./B with agreement 0/0=0
+    for sparse A and B, only the nonzero entries of B are used
     """
+    if sparse.issparse(B):
+        B = sparse.csr_matrix(B, copy=True)
+        B.data = 1 / B.data
+        return sparse.csr_matrix(B.multiply(A))
     B[B == 0] = np.inf
     return np.divide(A, B)
 
@@ -43,7 +53,12 @@ def capacity2stochastic(C):
     """
     convert capacity matrix into stochastic matrix
     S=C./(sR*ones(1,n))
+    sparse capacity matrix gives sparse stochastic matrix
     """
+    if sparse.issparse(C):
+        sR = np.ravel(C.sum(axis=1))
+        sR[sR == 0] = np.inf
+        return sparse.diags(1 / sR).dot(sparse.csr_matrix(C)).tocsr()
     C = sparse.csc_matrix(C)
     n = C.shape[0]
     sR = sparse.csc_matrix(C.sum(axis=1))
@@ -86,11 +101,352 @@ def markov(S, kappa=1):
         return np.dot(Xp, y)
 
 
+def sparseMarkov(S, kappa=1):
+    """
+    convert sparse stochastic matrix into steady state Markov vector
+    by sparse direct solve of (S'-I)*pi=0 where the last equation
+    is replaced by sum(pi)=kappa
+    """
+    S = sparse.csr_matrix(S)
+    n = S.shape[0]
+    X = sparse.vstack([(S.T - sparse.identity(n, format='csr'))[:-1, :],
+                       sparse.csr_matrix(np.ones((1, n)))]).tocsc()
+    y = np.zeros(n)
+    y[-1] = kappa
+    pi = splinalg.spsolve(X, y)
+    return pi.reshape(n, 1)
+
+
+def coordinatePartition(x, y, numBlocks):
+    """
+    return block label of each node by recursive coordinate bisection:
+    the nodes are split along their longest coordinate extent
+    in proportion to the number of blocks on each side
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    labels = np.zeros(len(x), dtype=int)
+
+    def bisect(idx, k, label):
+        if k <= 1 or len(idx) <= 1:
+            labels[idx] = label
+            return label + 1
+        k1 = k // 2
+        xy = x[idx] if np.ptp(x[idx]) >= np.ptp(y[idx]) else y[idx]
+        order = idx[np.argsort(xy, kind='stable')]
+        cut = len(idx) * k1 // k
+        label = bisect(order[:cut], k1, label)
+        return bisect(order[cut:], k - k1, label)
+
+    bisect(np.arange(len(x)), numBlocks, 0)
+    return labels
+
+
+def graphPartition(M, numBlocks):
+    """
+    return block label of each node by cutting
+    the reverse Cuthill-McKee ordering of the network
+    into contiguous blocks of equal number of nodes
+    """
+    A = sparse.csr_matrix(M)
+    n = A.shape[0]
+    A = ((A + A.T) != 0).astype(float).tocsr()
+    order = csgraph.reverse_cuthill_mckee(A, symmetric_mode=True)
+    labels = np.empty(n, dtype=int)
+    labels[order] = np.arange(n) * numBlocks // n
+    return labels
+
+
+def partitionMarkov(S, parts, kappa=1, workers=1, tol=1e-9):
+    """
+    convert sparse stochastic matrix into steady state Markov vector
+    by domain decomposition with stochastic complementation.
+    Nodes linked to another block (region) form the interface.
+    The interior of each region is eliminated in parallel threads,
+    the stochastic complement on the interface is solved,
+    and then the interior of each region is solved back in parallel.
+    The result is the global Markov vector (no iteration);
+    if the residual is above tol, the global sparse direct solve is used.
+    input:
+    S = stochastic matrix of irreducible network
+    parts = block label of each node, e.g. from coordinatePartition()
+    kappa = total of Markov vector
+    workers = number of threads to solve the regions
+    tol = tolerance of residual |S'*pi-pi| (1-norm, pi sums to one)
+    return pi and dictionary of interface size and residual
+    """
+    S = sparse.csr_matrix(S)
+    n = S.shape[0]
+    labels, parts = np.unique(np.asarray(parts), return_inverse=True)
+    k = len(labels)
+    X = (sparse.identity(n, format='csr') - S).T.tocsr()  # X*pi = 0
+
+    # interface nodes: end nodes of links between regions
+    coo = S.tocoo()
+    isCross = parts[coo.row] != parts[coo.col]
+    isInterface = np.zeros(n, dtype=bool)
+    isInterface[coo.row[isCross]] = True
+    isInterface[coo.col[isCross]] = True
+    interface = np.flatnonzero(isInterface)
+    info = {'blocks': k, 'interface': len(interface), 'direct': False}
+    if k < 2 or len(interface) == 0 or len(interface) == n:
+        pi = sparseMarkov(S, 1)
+        info['direct'] = True
+        info['residual'] = markovResidual(S, pi)
+        return kappa * pi, info
+    interiors = [idx for idx in (np.flatnonzero((parts == b) & ~isInterface) for b in range(k)) if len(idx) > 0]
+    XG = X[interface]
+
+    def eliminate(idx):
+        # Schur complement contribution of the interior of a region
+        lu = splinalg.splu(X[idx][:, idx].tocsc())
+        XiG = X[idx][:, interface].tocsc()
+        cols = np.flatnonzero(np.diff(XiG.indptr))  # interface nodes linked to this interior
+        XiG = XiG[:, cols]
+        XGi = XG[:, idx].tocsr()
+        rows = np.flatnonzero(np.diff(XGi.indptr))
+        Y = lu.solve(XiG.toarray())
+        correction = XGi[rows].dot(Y)
+        return lu, XiG, cols, rows, correction
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        eliminated = list(executor.map(eliminate, interiors))
+
+    # stochastic complement on the interface
+    T = XG[:, interface].tocoo()
+    rows = [T.row]
+    cols = [T.col]
+    vals = [T.data]
+    for lu, XiG, c, r, correction in eliminated:
+        rr, cc = np.meshgrid(r, c, indexing='ij')
+        rows.append(rr.ravel())
+        cols.append(cc.ravel())
+        vals.append(-np.ravel(correction))
+    m = len(interface)
+    T = sparse.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), shape=(m, m))
+    T = sparse.vstack([T[:-1, :], sparse.csr_matrix(np.ones((1, m)))]).tocsc()
+    y = np.zeros(m)
+    y[-1] = 1
+    piInterface = splinalg.spsolve(T, y)
+
+    # back substitution of the interior of each region
+    def backSubstitute(args):
+        lu, XiG, c, r, correction = args
+        return -lu.solve(XiG.dot(piInterface[c]))
+
+    pi = np.zeros(n)
+    pi[interface] = piInterface
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for idx, sol in zip(interiors, executor.map(backSubstitute, eliminated)):
+            pi[idx] = sol
+    pi = pi / np.sum(pi)
+    info['residual'] = markovResidual(S, pi)
+    if not info['residual'] <= tol:
+        pi = np.ravel(sparseMarkov(S, 1))
+        info['direct'] = True
+        info['residual'] = markovResidual(S, pi)
+    return kappa * pi.reshape(n, 1), info
+
+
+def powerMarkov(S, kappa=1, tol=1e-10, maxIter=100000, pi0=None):
+    """
+    convert stochastic matrix into steady state Markov vector
+    by power iteration of the lazy chain (S+I)/2,
+    which has the same Markov vector and also converges for periodic networks
+    pi0 = initial Markov vector (warm start)
+    return pi and dictionary of iterations and residual
+    """
+    S = sparse.csr_matrix(S)
+    n = S.shape[0]
+    ST = S.T.tocsr()
+    pi = np.full(n, 1 / n) if pi0 is None else np.abs(np.ravel(pi0)) / np.sum(np.abs(pi0))
+    residual = markovResidual(S, pi)
+    iteration = 0
+    while residual > tol and iteration < maxIter:
+        iteration = iteration + 1
+        pi = 0.5 * (pi + ST.dot(pi))
+        if iteration % 10 == 0:
+            residual = markovResidual(S, pi)
+    residual = markovResidual(S, pi)
+    return kappa * pi.reshape(n, 1), {'iterations': iteration, 'residual': residual}
+
+
+def multilevelMarkov(S, kappa=1, tol=1e-10, maxIter=100, pi0=None, coarseSize=1000, smoothing=2, window=8):
+    """
+    convert stochastic matrix into steady state Markov vector
+    by multilevel aggregation W-cycles on A*pi=0 with A=I-S'.
+    Strongly coupled nodes (with respect to pi) are aggregated into the nodes
+    of the coarser level until coarseSize nodes, which are solved by sparse direct.
+    In every cycle each level is smoothed by block Gauss-Seidel over its aggregates
+    (each aggregate solved exactly), the coarse problem is built by Galerkin product
+    and pi is corrected by disaggregation. The cycles are accelerated by minimizing
+    |A*pi| over the affine combinations of the last window cycles.
+    The aggregates are built once from the initial pi, thus a warm start
+    pi0 (e.g. pi of a previous scenario) also gives the aggregates;
+    a cold start rebuilds them once after the first cycle.
+    If the residual is still above tol after maxIter cycles, a warning is given
+    and the sparse direct solve (sparseMarkov) is used.
+    return pi and dictionary of iterations, residual, levels and direct
+    """
+    S = sparse.csr_matrix(S)
+    n = S.shape[0]
+    A = (sparse.identity(n, format='csr') - S).T.tocsr()
+    A.sum_duplicates()
+    A.sort_indices()
+    coo = A.tocoo()
+    pi = np.full(n, 1 / n) if pi0 is None else np.abs(np.ravel(pi0)) / np.sum(np.abs(pi0))
+
+    def hierarchy(x):
+        # aggregates of each level and the position of the links in the coarser level
+        levels = []
+        row, col, data = coo.row, coo.col, coo.data
+        m = n
+        while m > coarseSize:
+            B = sparse.csr_matrix((data, (row, col)), shape=(m, m))
+            labels = aggregate(B.dot(sparse.diags(x)))
+            nc = np.max(labels) + 1
+            if nc >= m:
+                break
+            pairs, index = np.unique(labels[row].astype(np.int64) * nc + labels[col], return_inverse=True)
+            order = np.argsort(labels, kind='stable')
+            position = np.empty(m, dtype=np.int64)
+            position[order] = np.arange(m)
+            levels.append({'size': m, 'labels': labels, 'numAggregates': nc, 'numPairs': len(pairs),
+                           'row': row, 'col': col, 'index': index,
+                           'order': order, 'position': position,
+                           'isLower': labels[row] >= labels[col]})  # block lower triangle in aggregate order
+            data = np.bincount(index, weights=data * x[col], minlength=len(pairs))
+            row, col = pairs // nc, pairs % nc
+            x = np.bincount(labels, weights=x, minlength=nc)
+            m = nc
+        return levels, (row, col, m)
+
+    def smoother(level, data):
+        # block Gauss-Seidel: solve (block lower triangle of B)*x = -(rest of B)*x
+        m, row, col, isLower, position = level['size'], level['row'], level['col'], level['isLower'], level['position']
+        L = sparse.csc_matrix((data[isLower], (position[row[isLower]], position[col[isLower]])), shape=(m, m))
+        U = sparse.csr_matrix((data[~isLower], (row[~isLower], col[~isLower])), shape=(m, m))
+        lu = splinalg.splu(L, permc_spec='NATURAL', diag_pivot_thresh=0, options={'SymmetricMode': True})
+        order = level['order']
+
+        def smooth(x):
+            for _ in range(smoothing):
+                x = np.abs(lu.solve(-U.dot(x)[order])[position])
+            return x / np.sum(x)
+        return smooth
+
+    def nullVector(data):
+        # coarsest level: the equation of the last node is replaced by x=1 (keeps the sparsity)
+        row, col, m = coarsest
+        isKept = row != m - 1
+        X = sparse.csc_matrix((np.append(data[isKept], 1.0), (np.append(row[isKept], m - 1),
+                                                            np.append(col[isKept], m - 1))), shape=(m, m))
+        y = np.zeros(m)
+        y[-1] = 1
+        x = np.abs(splinalg.spsolve(X, y))
+        return x / np.sum(x)
+
+    def cycle(level, data, x):
+        if level == len(levels):
+            return nullVector(data)
+        current = levels[level]
+        smooth = fineSmooth if level == 0 else smoother(current, data)
+        x = smooth(x)
+        coarseData = np.bincount(current['index'], weights=data * x[current['col']], minlength=current['numPairs'])
+        nc = current['numAggregates']
+        y = np.full(nc, 1 / nc)
+        for _ in range(2 if level + 1 < len(levels) else 1):
+            y = cycle(level + 1, coarseData, y)
+        x = x * y[current['labels']]
+        return smooth(x / np.sum(x))
+
+    levels, coarsest = hierarchy(pi)
+    fineSmooth = smoother(levels[0], coo.data) if levels else None
+    r = A.dot(pi)
+    residual = np.sum(np.abs(r))
+    iterates, residuals = [], []
+    iteration = 0
+    while residual > tol and iteration < maxIter:
+        iteration = iteration + 1
+        if iteration == 2 and pi0 is None:
+            levels, coarsest = hierarchy(pi)
+            fineSmooth = smoother(levels[0], coo.data) if levels else None
+        x = cycle(0, coo.data, pi)
+        r = A.dot(x)
+        iterates = (iterates + [x])[-window:]
+        residuals = (residuals + [r])[-window:]
+        if len(iterates) > 1:
+            # minimize |A*pi| over the affine combinations of the last cycles
+            D = np.column_stack(residuals[:-1]) - r[:, None]
+            c = np.linalg.lstsq(D, -r, rcond=None)[0]
+            y = x + (np.column_stack(iterates[:-1]) - x[:, None]).dot(c)
+            if np.all(y >= 0) and np.sum(y) > 0:
+                x, r = y / np.sum(y), (r + D.dot(c)) / np.sum(y)
+        pi = x
+        residual = np.sum(np.abs(r))
+    residual = markovResidual(S, pi)
+    info = {'iterations': iteration, 'residual': residual, 'levels': len(levels) + 1, 'direct': False}
+    if not residual <= tol:
+        warnings.warn("multilevel Markov solver did not converge in " + str(maxIter) + " cycles (residual " +
+                      "{:.2e}".format(residual) + "), sparse direct solve is used")
+        pi = np.ravel(sparseMarkov(S, 1))
+        info['direct'] = True
+        info['residual'] = markovResidual(S, pi)
+    return kappa * pi.reshape(n, 1), info
+
+
+def aggregate(A, maxSize=8):
+    """
+    return aggregate label of each node of (scaled) matrix A:
+    each node is joined with the neighbor of strongest coupling
+    max(|a_ij|+|a_ji|), the connected nodes form an aggregate
+    and long aggregates (e.g. along a road) are cut in the
+    Cuthill-McKee order into pieces of at most maxSize nodes
+    """
+    A = sparse.csr_matrix(A)
+    n = A.shape[0]
+    W = abs(A - sparse.diags(A.diagonal()))
+    W = (W + W.T).tocsr()
+    W.eliminate_zeros()
+    W.sort_indices()
+    # strongest neighbor: first entry of each row in descending order of coupling
+    nodes = np.repeat(np.arange(n), np.diff(W.indptr))
+    ranking = np.lexsort((-W.data, nodes))
+    isFirst = np.concatenate([[True], nodes[ranking][1:] != nodes[ranking][:-1]])[:len(ranking)]
+    rows = nodes[ranking[isFirst]]
+    strongest = W.indices[ranking[isFirst]]
+    G = sparse.csr_matrix((np.ones(len(rows)), (rows, strongest)), shape=(n, n))
+    G = (G + G.T).tocsr()
+    numComponents, component = csgraph.connected_components(G, directed=False)
+    order = csgraph.reverse_cuthill_mckee(G, symmetric_mode=True)
+    order = order[np.argsort(component[order], kind='stable')]
+    position = np.empty(n, dtype=np.int64)
+    position[order] = np.arange(n)
+    first = np.full(numComponents, n, dtype=np.int64)
+    np.minimum.at(first, component, position)
+    rank = position - first[component]
+    _, labels = np.unique(component.astype(np.int64) * n + rank // maxSize, return_inverse=True)
+    return labels
+
+
+def markovResidual(S, pi):
+    """
+    return 1-norm residual |S'*pi-pi| of Markov vector pi
+    """
+    pi = np.ravel(pi)
+    if sparse.issparse(S):
+        return np.sum(np.abs(S.T.dot(pi) - pi))
+    return np.sum(np.abs(np.ravel(np.dot(pi, S)) - pi))
+
+
 def idealFlow(S, pi):
     """
     return ideal flow matrix
     based on stochastic matrix and Markov vector
+    sparse stochastic matrix gives sparse ideal flow matrix
     """
+    if sparse.issparse(S):
+        return sparse.diags(np.ravel(pi)).dot(S).tocsr()
     [m, n] = S.shape
     jT = np.ones((1, n))
     return np.multiply(np.dot(pi, jT), S)
@@ -117,6 +473,313 @@ def capacity2idealFlow(C, kappa=1):
     return idealFlow(S, pi)
 
 
+def linkStochastic(rows, weights, n):
+    """
+    return stochastic value of each link (weight divided by the total weight
+    of the links out of its start node), rows = start node index of each link
+    """
+    rowSum = np.bincount(rows, weights=weights, minlength=n)
+    return np.divide(weights, rowSum[rows], out=np.zeros(len(weights)), where=rowSum[rows] > 0)
+
+
+def linkMarkovPattern(rows, cols, n):
+    """
+    return sparse pattern of the Markov system (S'-I)*pi=0 with the last
+    equation replaced by sum(pi)=1 of a network given by the start and end
+    node index of each link, to fill with linkMarkovMatrix
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    isLink = cols < n - 1
+    diagonal = np.arange(n - 1)
+    entryRow = np.concatenate([cols[isLink], diagonal, np.full(n, n - 1)])
+    entryCol = np.concatenate([rows[isLink], diagonal, np.arange(n)])
+    keys, entry = np.unique(entryCol * n + entryRow, return_inverse=True)
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(keys // n, minlength=n))])
+    return {'n': n, 'isLink': isLink, 'entry': entry.ravel(), 'indices': keys % n, 'indptr': indptr,
+            'fixed': np.concatenate([-np.ones(n - 1), np.ones(n)])}
+
+
+def linkMarkovMatrix(pattern, stochastic):
+    """
+    return sparse (csc) matrix of the Markov system for the stochastic value of each link
+    """
+    n = pattern['n']
+    values = np.concatenate([stochastic[pattern['isLink']], pattern['fixed']])
+    data = np.bincount(pattern['entry'], weights=values, minlength=len(pattern['indices']))
+    return sparse.csc_matrix((data, pattern['indices'], pattern['indptr']), shape=(n, n))
+
+
+def refineMarkov(X, lu, pi0=None, tol=1e-12, maxIter=50):
+    """
+    return Markov vector (sum=1) of the Markov system matrix X
+    by iterative refinement with the LU factorization of a nearby system
+    starting from pi0 (warm start), or None if it does not converge in maxIter steps
+    """
+    n = X.shape[0]
+    y = np.zeros(n)
+    y[-1] = 1
+    pi = lu.solve(y) if pi0 is None else np.ravel(pi0) / np.sum(pi0)
+    for _ in range(maxIter):
+        residual = y - X.dot(pi)
+        if np.sum(np.abs(residual)) < tol:
+            return pi
+        pi = pi + lu.solve(residual)
+    return None
+
+
+def batchIdealFlow(rows, cols, capacities, kappa=1, numNodes=None, chunkSize=64, tol=1e-12, maxIter=50):
+    """
+    convert a stack of capacity variants of the same network into ideal flows
+    rows, cols = node index (0..n-1) of the start and end node of each link
+    capacities = (k x m) array of k capacity vectors of the m links
+    kappa = total flow, scalar or vector of k values
+
+    all variants share the sparsity pattern of (S'-I) with the last
+    equation replaced by sum(pi)=kappa, and one sparse LU factorization
+    at the mean capacity. Each variant is solved by iterative refinement
+    with that factorization until the 1-norm residual < tol; a variant that
+    does not converge in maxIter steps is factorized on its own, reusing
+    the fill-reducing column order. The variants are processed in chunks
+    of chunkSize, thus the working memory is predictable.
+    A variant with singular system (e.g. a node without outgoing capacity) gets nan.
+    return (k x m) arrays of link flow and link congestion
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    capacities = np.atleast_2d(np.asarray(capacities, dtype=np.float64))
+    k, m = capacities.shape
+    n = int(max(rows.max(), cols.max()) + 1) if numNodes is None else numNodes
+    kappas = np.broadcast_to(np.asarray(kappa, dtype=np.float64), (k,))
+    pattern = linkMarkovPattern(rows, cols, n)
+    y = np.zeros(n)
+    y[-1] = 1
+
+    try:
+        lu = splinalg.splu(linkMarkovMatrix(pattern, linkStochastic(rows, np.mean(capacities, axis=0), n)))
+        colOrder = np.argsort(lu.perm_c)
+    except RuntimeError:
+        lu = None
+        colOrder = None
+
+    def solve(X):
+        pi = None if lu is None else refineMarkov(X, lu, tol=tol, maxIter=maxIter)
+        if pi is not None:
+            return pi
+        # factorize the variant on its own
+        if colOrder is None:
+            return splinalg.splu(X).solve(y)
+        z = splinalg.splu(X[:, colOrder], permc_spec='NATURAL').solve(y)
+        pi = np.empty(n)
+        pi[colOrder] = z
+        return pi
+
+    flows = np.empty((k, m))
+    congestions = np.empty((k, m))
+    for start in range(0, k, chunkSize):
+        end = min(start + chunkSize, k)
+        chunk = capacities[start:end]
+        rowSums = np.array([np.bincount(rows, weights=capacity, minlength=n) for capacity in chunk])
+        S = np.divide(chunk, rowSums[:, rows], out=np.zeros_like(chunk), where=rowSums[:, rows] > 0)
+        pis = np.empty((end - start, n))
+        for j in range(end - start):
+            try:
+                pis[j] = solve(linkMarkovMatrix(pattern, S[j]))
+            except RuntimeError:
+                pis[j] = np.nan
+        flows[start:end] = kappas[start:end, None] * pis[:, rows] * S
+        congestions[start:end] = np.divide(flows[start:end], chunk, out=np.zeros_like(chunk), where=chunk > 0)
+    return flows, congestions
+
+
+def originFlow(S, pi, origins, chunkSize=64, workers=1):
+    """
+    decompose the ideal flow by origin: the origin of the flow on a link is
+    the last origin node that the flow passed. With Q = S without the links
+    into the origins, the expected visits v_o of flow leaving origin o
+    before it reaches an origin again is the solution of (I-Q)'*v_o = e_o,
+    and the flow of origin o on link (i,j) is pi_o * v_o(i) * S_ij.
+    The flows of all origins sum to the ideal flow.
+    (I-Q)' is factorized once (sparse LU); the origins are solved in chunks
+    of chunkSize (in parallel by workers) and streamed.
+    S = sparse stochastic matrix, pi = Markov vector (total flow kappa)
+    origins = node index of the origins
+    yield for each chunk:
+        origin node index (c),
+        link flow (c x number of links, links in the order of S in csr format),
+        origin-destination flow to each origin (c x number of origins)
+    """
+    S = sparse.csr_matrix(S)
+    n = S.shape[0]
+    pi = np.ravel(pi)
+    origins = np.asarray(origins, dtype=np.int64)
+    notOrigin = np.ones(n)
+    notOrigin[origins] = 0
+    Q = S.dot(sparse.diags(notOrigin))
+    lu = splinalg.splu((sparse.identity(n, format='csr') - Q).T.tocsc())
+    linkRow = np.repeat(np.arange(n), np.diff(S.indptr))
+    toOrigin = S[:, origins].tocsc()
+
+    def solve(chunk):
+        E = np.zeros((n, len(chunk)))
+        E[chunk, np.arange(len(chunk))] = 1
+        V = lu.solve(E).T * pi[chunk][:, None]  # expected flow through each node
+        return chunk, V[:, linkRow] * S.data, np.asarray(toOrigin.T.dot(V.T).T)
+
+    chunks = [origins[start:start + chunkSize] for start in range(0, len(origins), chunkSize)]
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for start in range(0, len(chunks), workers):
+                for result in executor.map(solve, chunks[start:start + workers]):
+                    yield result
+    else:
+        for chunk in chunks:
+            yield solve(chunk)
+
+
+def randomWalk(S, starts, numSteps, rng):
+    """
+    return random walks (number of starts x numSteps+1 node index) on the
+    stochastic matrix S (csr) from the start nodes, drawn by rng.
+    Each step finds the next node by binary search of u + row index in the
+    cumulative probability of the rows shifted by their row index
+    (a node without outgoing link keeps the walk there)
+    """
+    S = sparse.csr_matrix(S)
+    n = S.shape[0]
+    rowLength = np.diff(S.indptr)
+    rowSum = np.bincount(np.repeat(np.arange(n), rowLength), weights=S.data, minlength=n)
+    rowSum[rowSum == 0] = 1
+    shift = np.repeat(np.arange(n), rowLength)
+    cumulative = shift + (np.cumsum(S.data) - np.repeat(np.cumsum(rowSum) - rowSum, rowLength)) / rowSum[shift]
+    walks = np.empty((len(starts), numSteps + 1), dtype=np.int64)
+    walks[:, 0] = starts
+    node = np.asarray(starts, dtype=np.int64)
+    for step in range(1, numSteps + 1):
+        u = rng.random(len(node))
+        position = np.searchsorted(cumulative, node + u, side='right')
+        position = np.minimum(position, S.indptr[node + 1] - 1)
+        node = np.where(rowLength[node] > 0, S.indices[np.maximum(position, 0)], node)
+        walks[:, step] = node
+    return walks
+
+
+def sampleTrajectories(S, numWalks, numSteps, pi=None, seed=0, batchSize=10000, workers=1,
+                       fileName=None, labels=None):
+    """
+    return numWalks random walks of numSteps steps on the stochastic matrix S
+    as (numWalks x numSteps+1) integer array of node index (or labels[node index]),
+    the start nodes are drawn from the Markov vector pi (default: markov of S),
+    thus the trajectories are consistent with the ideal flow.
+    The walks are sampled in batches of batchSize (in parallel by workers),
+    every batch with its own seed spawned from seed, thus the result does not depend
+    on the number of workers. If fileName is given, the batches are written into
+    a memory mapped .npy file of int32 (or int64 for large labels).
+    """
+    S = sparse.csr_matrix(S)
+    n = S.shape[0]
+    if pi is None:
+        pi = sparseMarkov(S)
+    cumulativePi = np.cumsum(np.ravel(pi) / np.sum(pi))
+    labels = np.arange(n) if labels is None else np.asarray(labels)
+    dtype = np.int32 if np.max(np.abs(labels)) < 2 ** 31 else np.int64
+    if fileName is None:
+        trajectories = np.empty((numWalks, numSteps + 1), dtype=dtype)
+    else:
+        trajectories = np.lib.format.open_memmap(fileName, mode='w+', dtype=dtype, shape=(numWalks, numSteps + 1))
+    starts = list(range(0, numWalks, batchSize))
+    seeds = np.random.SeedSequence(seed).spawn(len(starts))
+
+    def sample(i):
+        rng = np.random.default_rng(seeds[i])
+        size = min(batchSize, numWalks - starts[i])
+        startNodes = np.minimum(np.searchsorted(cumulativePi, rng.random(size), side='right'), n - 1)
+        trajectories[starts[i]:starts[i] + size] = labels[randomWalk(S, startNodes, numSteps, rng)]
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(sample, range(len(starts))))
+    else:
+        for i in range(len(starts)):
+            sample(i)
+    if fileName is not None:
+        trajectories.flush()
+    return trajectories
+
+
+def trajectoryCounts(chunks, rows, cols, numNodes=None, labels=None, weights=None, workers=1):
+    """
+    return the number of transitions of the trajectories on each link and
+    the number of transitions without link
+    chunks = iterable of trajectory chunks, each a 2D array (trajectory x position,
+             padded by any value that is not a node) or a list of 1D arrays of node labels
+    rows, cols = node index (0..n-1) of the start and end node of each link
+    labels = node label of each node index (default: node index)
+    weights = share of parallel links (same start and end node) in the transitions,
+              e.g. capacity (default: equal share)
+    the chunks are counted independently (in parallel by workers), thus only
+    workers chunks and one count per link are in memory.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    n = int(max(rows.max(), cols.max()) + 1) if numNodes is None else numNodes
+    labels = np.arange(n) if labels is None else np.asarray(labels)
+    order = np.argsort(labels)
+    sortedLabels = labels[order]
+    linkKey = rows * n + cols
+    keys, keyIndex = np.unique(linkKey, return_inverse=True)
+    keyIndex = keyIndex.ravel()
+
+    def count(chunk):
+        if isinstance(chunk, (list, tuple)):
+            sequences = [np.asarray(sequence) for sequence in chunk if len(sequence) > 1]
+            if not sequences:
+                return np.zeros(len(keys), dtype=np.int64), 0
+            first = np.concatenate([sequence[:-1] for sequence in sequences])
+            second = np.concatenate([sequence[1:] for sequence in sequences])
+        else:
+            chunk = np.asarray(chunk)
+            first, second = chunk[:, :-1].ravel(), chunk[:, 1:].ravel()
+        node = []
+        for label in (first, second):
+            position = np.minimum(np.searchsorted(sortedLabels, label), n - 1)
+            isNode = sortedLabels[position] == label
+            node.append(np.where(isNode, order[position], -1))
+        a, b = node
+        isTransition = (a >= 0) & (b >= 0) & (a != b)
+        key = a[isTransition] * n + b[isTransition]
+        position = np.minimum(np.searchsorted(keys, key), len(keys) - 1)
+        isLink = keys[position] == key
+        return np.bincount(position[isLink], minlength=len(keys)), np.sum(~isLink)
+
+    keyCounts = np.zeros(len(keys), dtype=np.int64)
+    unmatched = 0
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            batch = []
+            for chunk in chunks:
+                batch.append(chunk)
+                if len(batch) == workers:
+                    for counts, missing in executor.map(count, batch):
+                        keyCounts += counts
+                        unmatched += missing
+                    batch = []
+            for counts, missing in executor.map(count, batch):
+                keyCounts += counts
+                unmatched += missing
+    else:
+        for chunk in chunks:
+            counts, missing = count(chunk)
+            keyCounts += counts
+            unmatched += missing
+
+    # share of parallel links
+    weights = np.ones(len(rows)) if weights is None else np.asarray(weights, dtype=float)
+    keyWeight = np.bincount(keyIndex, weights=weights, minlength=len(keys))
+    share = np.divide(weights, keyWeight[keyIndex], out=np.zeros(len(rows)), where=keyWeight[keyIndex] > 0)
+    return keyCounts[keyIndex] * share, int(unmatched)
+
+
 def sumOfRow(M):
     """
     return vector sum of rows
@@ -184,6 +847,11 @@ def isIrreducible(M):
     """
     return True if M is irreducible matrix
     """
+    if sparse.issparse(M):
+        if isSquare(M) and M.min() >= 0:
+            k, _ = csgraph.connected_components(M, directed=True, connection='strong')
+            return k == 1
+        return False
     if isSquare(M) and isNonNegative(M):
         [m, n] = M.shape
         I = np.eye(n)
@@ -233,7 +901,7 @@ def equivalentIFN(F, scaling):
     return F1
 
 
-def globalScaling(F, scalingType='min', val=1):
+def globalScaling(F, scalingType='min', val=1, maxInteger=None):
     """
     return scaling factor to ideal flow matrix
     to get equivalentIFN
@@ -241,7 +909,8 @@ def globalScaling(F, scalingType='min', val=1):
     F = ideal flow matrix
     scalingType = {'min','max','sum','int'}
     val = value of the min, max, or sum
-    'int' means basis IFN (minimum integer)
+    'int' means basis IFN (minimum integer), see integerIFN;
+    raise ValueError if the scaling exceeds maxInteger (None = no bound)
     """
     f = np.ravel(F[np.nonzero(F)])  # list of non-zero values in F
 
@@ -253,18 +922,450 @@ def globalScaling(F, scalingType='min', val=1):
     elif scalingType == 'sum':
         scaling = val / sum(f)
     elif scalingType == 'int':
-        denomSet = set()
-        for g in f:
-            h = Fraction(g).limit_denominator(1000000000)
-            denomSet.add(h.denominator)
-        scaling = 1
-        for d in denomSet:
-            scaling = lcm(scaling, d)
+        _, denominators = rationalApproximation(f, 1000000000)
+        scaling = lcmReduce(denominators, maxInteger)
     else:
         raise ValueError("unknown scalingType")
     return scaling
 
 
+def gehStatistic(estimated, observed):
+    """
+    return GEH statistic of each link
+    GEH = sqrt(2 (estimated - observed)^2 / (estimated + observed))
+    """
+    estimated = np.asarray(estimated, dtype=float)
+    observed = np.asarray(observed, dtype=float)
+    total = estimated + observed
+    return np.sqrt(np.divide(2 * (estimated - observed) ** 2, total, out=np.zeros_like(total), where=total > 0))
+
+
+def objectiveSSE(scaling, basis, observed, weights=None, **parameters):
+    """
+    return (weighted) sum of squared error of scaling * basis to the observed flow
+    """
+    error = observed - scaling * basis
+    return np.sum(error ** 2) if weights is None else np.sum(weights * error ** 2)
+
+
+def objectiveWLS(scaling, basis, observed, weights=None, **parameters):
+    """
+    return sum of squared error weighted by 1/observed (Poisson counts) if no weights
+    """
+    if weights is None:
+        weights = 1 / np.maximum(observed, 1)
+    return objectiveSSE(scaling, basis, observed, weights)
+
+
+def objectiveGEH(scaling, basis, observed, weights=None, **parameters):
+    """
+    return (weighted) sum of squared GEH statistics
+    """
+    geh2 = gehStatistic(scaling * basis, observed) ** 2
+    return np.sum(geh2) if weights is None else np.sum(weights * geh2)
+
+
+def objectiveL1(scaling, basis, observed, weights=None, **parameters):
+    """
+    return (weighted) sum of absolute error (robust to outlying counters)
+    """
+    error = np.abs(observed - scaling * basis)
+    return np.sum(error) if weights is None else np.sum(weights * error)
+
+
+def objectiveHuber(scaling, basis, observed, weights=None, delta=None, **parameters):
+    """
+    return (weighted) sum of Huber loss: squared error up to delta, absolute error beyond
+    (robust to outlying counters); delta default = 1.345 * robust standard deviation of observed
+    """
+    if delta is None:
+        delta = 1.345 * 1.4826 * np.median(np.abs(observed - np.median(observed)))
+    error = np.abs(observed - scaling * basis)
+    loss = np.where(error <= delta, 0.5 * error ** 2, delta * (error - 0.5 * delta))
+    return np.sum(loss) if weights is None else np.sum(weights * loss)
+
+
+# registry of calibration objectives to be minimized: name -> f(scaling, basis, observed, weights, **parameters)
+calibrationObjectives = {'SSE': objectiveSSE,
+                         'R^2': objectiveSSE,
+                         'WLS': objectiveWLS,
+                         'GEH': objectiveGEH,
+                         'L1': objectiveL1,
+                         'huber': objectiveHuber}
+
+
+def optimalScaling(basis, observed, criterion='SSE', weights=None, tol=1e-10, **parameters):
+    """
+    return scaling factor minimizing the calibration objective
+    (see calibrationObjectives) of scaling * basis to the observed flow, and the objective value.
+    SSE, R^2 and WLS have closed form; L1 is the weighted median of observed/basis;
+    other objectives are minimized by bounded Brent search
+    between the minimum and maximum of observed/basis
+    (the objectives are sums of convex functions with minimum at observed/basis).
+    input:
+    basis, observed = aligned arrays of basis flow and observed flow of the counted links
+    weights = weight of each count (None = equal)
+    """
+    basis = np.asarray(basis, dtype=float)
+    observed = np.asarray(observed, dtype=float)
+    if criterion not in calibrationObjectives:
+        raise ValueError("unknown criterion " + str(criterion) + ", use one of " + str(list(calibrationObjectives)))
+    objective = calibrationObjectives[criterion]
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)
+    if criterion == 'WLS' and weights is None:
+        weights = 1 / np.maximum(observed, 1)
+
+    if criterion in ('SSE', 'R^2', 'WLS'):
+        w = np.ones(len(basis)) if weights is None else weights
+        scaling = np.sum(w * observed * basis) / np.sum(w * basis ** 2)
+    elif criterion == 'L1':
+        ratio = observed / basis
+        w = basis if weights is None else weights * basis
+        order = np.argsort(ratio)
+        cumulative = np.cumsum(w[order])
+        scaling = ratio[order][np.searchsorted(cumulative, cumulative[-1] / 2)]
+    else:
+        ratio = observed / basis
+        low, high = np.min(ratio), np.max(ratio)
+        if high > low:
+            result = optimize.minimize_scalar(lambda x: objective(x, basis, observed, weights, **parameters),
+                                              bounds=(low, high), method='bounded',
+                                              options={'xatol': tol * high})
+            scaling = result.x
+        else:
+            scaling = low
+    return scaling, objective(scaling, basis, observed, weights, **parameters)
+
+
+def bootstrapScaling(basis, observed, numSamples=1000, criterion='SSE', weights=None, groups=None, seed=0,
+                     batchSize=1000, workers=1):
+    """
+    return optimal scaling factor (see optimalScaling) of numSamples bootstrap resamples
+    of the counts (or of the count stations: groups = station index 0..g-1 of each count,
+    all counts of a resampled station are taken together).
+    SSE, R^2 and WLS use the closed form on the per station sums of w*observed*basis
+    and w*basis^2, thus a batch of resamples is two sums over the resampled stations;
+    other criteria are optimized for each resample.
+    The resamples are drawn in batches of batchSize (in parallel by workers),
+    every batch with its own seed spawned from seed, thus the result does not depend on the workers.
+    """
+    basis = np.asarray(basis, dtype=float)
+    observed = np.asarray(observed, dtype=float)
+    groups = np.arange(len(basis)) if groups is None else np.asarray(groups, dtype=np.int64)
+    numGroups = int(groups.max()) + 1
+    w = np.ones(len(basis)) if weights is None else np.asarray(weights, dtype=float)
+    if criterion == 'WLS' and weights is None:
+        w = 1 / np.maximum(observed, 1)
+    isClosedForm = criterion in ('SSE', 'R^2', 'WLS')
+    if isClosedForm:
+        sumFB = np.bincount(groups, weights=w * observed * basis, minlength=numGroups)
+        sumBB = np.bincount(groups, weights=w * basis ** 2, minlength=numGroups)
+    else:
+        order = np.argsort(groups, kind='stable')
+        start = np.searchsorted(groups[order], np.arange(numGroups + 1))
+    scalings = np.empty(numSamples)
+    starts = list(range(0, numSamples, batchSize))
+    seeds = np.random.SeedSequence(seed).spawn(len(starts))
+
+    def sample(i):
+        rng = np.random.default_rng(seeds[i])
+        size = min(batchSize, numSamples - starts[i])
+        if isClosedForm:
+            picked = rng.integers(0, numGroups, (size, numGroups))
+            scalings[starts[i]:starts[i] + size] = np.sum(sumFB[picked], axis=1) / np.sum(sumBB[picked], axis=1)
+            return
+        for j in range(size):
+            picked = rng.integers(0, numGroups, numGroups)
+            index = order[np.concatenate([np.arange(start[g], start[g + 1]) for g in picked])]
+            scalings[starts[i] + j], _ = optimalScaling(basis[index], observed[index], criterion,
+                                                        None if weights is None else w[index])
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(sample, range(len(starts))))
+    else:
+        for i in range(len(starts)):
+            sample(i)
+    return scalings
+
+
+def leaveOneOutScaling(basis, observed, criterion='SSE', weights=None, groups=None):
+    """
+    return optimal scaling factor (see optimalScaling) leaving out each count station
+    (groups = station index 0..g-1 of each count, default: each count is a station)
+    and the prediction error of the left out counts (sum of squared error at that scaling).
+    SSE, R^2 and WLS subtract the station sums from the total sums (closed form);
+    other criteria are optimized for each station.
+    """
+    basis = np.asarray(basis, dtype=float)
+    observed = np.asarray(observed, dtype=float)
+    groups = np.arange(len(basis)) if groups is None else np.asarray(groups, dtype=np.int64)
+    numGroups = int(groups.max()) + 1
+    w = np.ones(len(basis)) if weights is None else np.asarray(weights, dtype=float)
+    if criterion == 'WLS' and weights is None:
+        w = 1 / np.maximum(observed, 1)
+    if criterion in ('SSE', 'R^2', 'WLS'):
+        sumFB = np.bincount(groups, weights=w * observed * basis, minlength=numGroups)
+        sumBB = np.bincount(groups, weights=w * basis ** 2, minlength=numGroups)
+        remainingBB = np.sum(sumBB) - sumBB
+        scalings = np.divide(np.sum(sumFB) - sumFB, remainingBB, out=np.full(numGroups, np.nan),
+                             where=remainingBB > 0)
+    else:
+        scalings = np.array([optimalScaling(basis[groups != g], observed[groups != g], criterion,
+                                            None if weights is None else w[groups != g])[0]
+                             if np.any(groups != g) else np.nan for g in range(numGroups)])
+    errors = np.bincount(groups, weights=(observed - scalings[groups] * basis) ** 2, minlength=numGroups)
+    return scalings, errors
+
+
+def adjointCapacityGradient(rows, cols, rowSum, s, p, lu, dJdq):
+    """
+    return gradient of outputs J with respect to the capacity of each link
+    through the unit link flow q = p[rows] * s (Markov vector p with sum=1, link stochastic s)
+    by the adjoint of the Markov system X p = e (see linkMarkovPattern):
+    X^T lambda = dJ/dp, dJ/ds = dJ/dq p[rows] - lambda[cols] p[rows], and s = capacity / rowSum[rows].
+    lu = sparse LU factorization of X, rowSum = total capacity out of each node,
+    dJdq = dJ/dq of each link, or (k x m) array for k outputs (k transposed solves)
+    """
+    dJdq = np.asarray(dJdq, dtype=np.float64)
+    isVector = dJdq.ndim == 1
+    dJdq = np.atleast_2d(dJdq)
+    n = len(rowSum)
+    m = len(rows)
+    isLink = cols < n - 1
+    sumQ = np.array([np.bincount(rows, weights=g * s, minlength=n) for g in dJdq])
+    lam = np.atleast_2d(lu.solve(np.ascontiguousarray(sumQ.T), trans='T').T)
+    dJds = dJdq * p[rows] - np.where(isLink, lam[:, cols] * p[rows], 0)
+    sumS = np.array([np.bincount(rows, weights=g * s, minlength=n) for g in dJds])
+    dJdc = np.divide(dJds - sumS[:, rows], rowSum[rows], out=np.zeros((len(dJdq), m)), where=rowSum[rows] > 0)
+    return dJdc[0] if isVector else dJdc
+
+
+def linkFlowSensitivity(rows, cols, capacity, dJdf, kappa=1, numNodes=None):
+    """
+    return ideal flow of each link (total flow kappa) and the gradient of outputs J(flow)
+    with respect to the capacity of each link, by one sparse LU factorization
+    and one transposed solve per output (instead of one solve per link by finite differences).
+    rows, cols = node index (0..n-1) of the start and end node of each link
+    dJdf = function of the link flow returning dJ/dflow of each link (m),
+           or (k x m) array for k outputs; only the dependence through the flow is included,
+           add the direct dependence of J on the capacity (e.g. congestion = flow / capacity)
+    return flow (m) and gradient (m, or k x m)
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    capacity = np.asarray(capacity, dtype=np.float64)
+    n = int(max(rows.max(), cols.max()) + 1) if numNodes is None else numNodes
+    rowSum = np.bincount(rows, weights=capacity, minlength=n)
+    s = np.divide(capacity, rowSum[rows], out=np.zeros(len(rows)), where=rowSum[rows] > 0)
+    lu = splinalg.splu(linkMarkovMatrix(linkMarkovPattern(rows, cols, n), s))
+    e = np.zeros(n)
+    e[-1] = 1
+    p = lu.solve(e)
+    flow = kappa * p[rows] * s
+    if callable(dJdf):
+        dJdf = dJdf(flow)
+    return flow, adjointCapacityGradient(rows, cols, rowSum, s, p, lu, kappa * np.asarray(dJdf, dtype=np.float64))
+
+
+def calibrateCapacity(rows, cols, capacity, observed, groups=None, weights=None, regularization=0.01,
+                      bounds=(0.1, 10), numNodes=None, tol=1e-9, maxIter=500):
+    """
+    return calibrated capacity of each link such that the ideal flow
+    (with the optimal total flow kappa) fits the observed flow on the counted links,
+    the calibrated ideal flow of each link and dictionary of information.
+    rows, cols = node index (0..n-1) of the start and end node of each link
+    capacity = imputed capacity of each link
+    observed = observed flow of each link (nan for links without count)
+    groups = group index (0..g-1) of each link sharing one capacity multiplier,
+             e.g. road type (default: one multiplier per link)
+    weights = weight of each count (default: 1)
+    bounds = lower and upper bound of the multipliers (capacity stays positive)
+
+    minimize over log multipliers u:
+        sum(w (kappa p[rows] s - observed)^2) / sum(w observed^2) + regularization * mean(u^2)
+    where s = link stochastic of capacity * exp(u[groups]) and p = Markov vector (sum=1).
+    kappa is the least squares optimum of each evaluation, thus (envelope theorem) the gradient
+    is the partial gradient at fixed kappa, obtained by the adjoint of the sparse Markov system:
+    one sparse LU factorization, one solve and one transposed solve per evaluation.
+    The regularization pulls the multipliers toward 1 (the imputed capacity), which also fixes
+    the multipliers that do not change the flow (e.g. all links out of a node multiplied together).
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    capacity = np.asarray(capacity, dtype=np.float64)
+    observed = np.asarray(observed, dtype=np.float64)
+    m = len(rows)
+    n = int(max(rows.max(), cols.max()) + 1) if numNodes is None else numNodes
+    groups = np.arange(m) if groups is None else np.asarray(groups, dtype=np.int64)
+    numGroups = int(groups.max()) + 1
+    isCounted = np.isfinite(observed)
+    w = np.where(isCounted, 1.0 if weights is None else np.asarray(weights, dtype=np.float64), 0.0)
+    y = np.where(isCounted, observed, 0.0)
+    scale = np.sum(w * y ** 2)
+    pattern = linkMarkovPattern(rows, cols, n)
+    e = np.zeros(n)
+    e[-1] = 1
+    state = {}
+
+    def objective(u):
+        c = capacity * np.exp(u[groups])
+        rowSum = np.bincount(rows, weights=c, minlength=n)
+        s = np.divide(c, rowSum[rows], out=np.zeros(m), where=rowSum[rows] > 0)
+        lu = splinalg.splu(linkMarkovMatrix(pattern, s))
+        p = lu.solve(e)
+        q = p[rows] * s
+        kappa = np.sum(w * y * q) / np.sum(w * q ** 2)
+        residual = kappa * q - y
+        J = np.sum(w * residual ** 2) / scale + regularization * np.mean(u ** 2)
+
+        g = 2 * w * residual * kappa / scale  # dJ/dq
+        dJdc = adjointCapacityGradient(rows, cols, rowSum, s, p, lu, g)
+        gradient = np.bincount(groups, weights=dJdc * c, minlength=numGroups) + \
+            2 * regularization * u / numGroups
+        state.update(capacity=c, flow=kappa * q, kappa=kappa)
+        return J, gradient
+
+    logBounds = [(np.log(bounds[0]), np.log(bounds[1]))] * numGroups
+    result = optimize.minimize(objective, np.zeros(numGroups), jac=True, method='L-BFGS-B', bounds=logBounds,
+                               options={'maxiter': maxIter, 'ftol': tol, 'gtol': tol})
+    J, _ = objective(result.x)
+    info = {'multiplier': np.exp(result.x), 'kappa': state['kappa'], 'objective': J,
+            'iterations': result.nit, 'evaluations': result.nfev, 'message': result.message}
+    return state['capacity'], state['flow'], info
+
+
+def goodnessOfFit(estimated, observed):
+    """
+    return dictionary of goodness of fit of estimated to observed flow:
+    SSE, R^2, RMSE, MAE, mean GEH and share of links with GEH < 5
+    """
+    estimated = np.asarray(estimated, dtype=float)
+    observed = np.asarray(observed, dtype=float)
+    SSE = np.sum((observed - estimated) ** 2)
+    SST = np.sum((observed - np.mean(observed)) ** 2)
+    geh = gehStatistic(estimated, observed)
+    return {'SSE': SSE,
+            'R^2': 1 - SSE / SST if SST > 0 else 1.0,
+            'RMSE': np.sqrt(SSE / len(observed)),
+            'MAE': np.mean(np.abs(observed - estimated)),
+            'GEH': np.mean(geh),
+            'GEH<5': np.mean(geh < 5)}
+
+
+def rationalApproximation(values, maxDenominator=1000000000):
+    """
+    return int64 arrays of numerator and denominator of the closest fraction
+    with denominator <= maxDenominator of each value, same as
+    Fraction(value).limit_denominator(maxDenominator).
+    The continued fraction expansion runs on all unique values together in float64
+    with int64 convergents; a convergent p/q is accepted when
+    2 maxDenominator (|x q - p| + rounding) < 1: then it is a convergent of the exact value,
+    the next one has denominator > maxDenominator and p/q is closer than the semiconvergent,
+    thus it is the result of limit_denominator. The other values (no small fraction
+    within rounding) use Fraction.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    unique, inverse = np.unique(values, return_inverse=True)
+    x = np.abs(unique)
+    sign = np.where(unique < 0, -1, 1)
+    p0, q0 = np.zeros(len(x), dtype=np.int64), np.ones(len(x), dtype=np.int64)
+    p1, q1 = np.ones(len(x), dtype=np.int64), np.zeros(len(x), dtype=np.int64)
+    remainder = x.copy()
+    isActive = np.isfinite(x)
+    isExact = np.zeros(len(x), dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for _ in range(64):
+            if not np.any(isActive):
+                break
+            a = np.floor(remainder[isActive])
+            q2 = q0[isActive] + a * q1[isActive]
+            isStop = ~(q2 <= maxDenominator)
+            index = np.flatnonzero(isActive)
+            keep = index[~isStop]
+            aKeep = a[~isStop].astype(np.int64)
+            p0[keep], q0[keep], p1[keep], q1[keep] = p1[keep], q1[keep], p0[keep] + aKeep * p1[keep], \
+                q0[keep] + aKeep * q1[keep]
+            fraction = remainder[keep] - aKeep
+            error = np.abs(x[keep] * q1[keep] - p1[keep]) + 2 * np.finfo(float).eps * x[keep] * q1[keep]
+            isDone = 2 * float(maxDenominator) * error < 1
+            isExact[keep[isDone]] = True
+            remainder[keep] = 1 / fraction
+            isActive[index[isStop]] = False
+            isActive[keep[isDone | (fraction <= 0)]] = False
+
+    numerators = sign * p1
+    denominators = q1.copy()
+    for i in np.flatnonzero(~isExact):
+        h = Fraction(float(unique[i])).limit_denominator(maxDenominator)
+        numerators[i], denominators[i] = h.numerator, h.denominator
+    return numerators[inverse.ravel()].reshape(values.shape), denominators[inverse.ravel()].reshape(values.shape)
+
+
+def lcmReduce(values, maxInteger=None):
+    """
+    return least common multiple of the positive integers in values.
+    Pairs are reduced by gcd in int64 (halving the array at each step) while
+    the lcm fits in int64, then the few remaining values are folded with Python integers.
+    Raise ValueError if the lcm exceeds maxInteger (None = no bound)
+    """
+    x = np.unique(np.asarray(values, dtype=np.int64))
+    bound = np.iinfo(np.int64).max
+    while len(x) > 1:
+        if len(x) % 2 == 1:
+            x = np.append(x, 1)
+        a, b = x[0::2], x[1::2]
+        t = a // np.gcd(a, b)
+        isSafe = t <= bound // b
+        if not np.all(isSafe):
+            # big integer fallback for the values that overflow int64
+            result = int(lcmReduce(np.concatenate([t[isSafe] * b[isSafe], [1]]), maxInteger))
+            for value in np.concatenate([a[~isSafe], b[~isSafe]]):
+                result = lcm(result, int(value))
+                if maxInteger is not None and result > maxInteger:
+                    raise ValueError("integer scaling exceeds " + str(maxInteger))
+            return result
+        x = np.unique(t * b)
+    result = int(x[0]) if len(x) else 1
+    if maxInteger is not None and result > maxInteger:
+        raise ValueError("integer scaling exceeds " + str(maxInteger))
+    return result
+
+
+def integerIFN(F, maxDenominator=1000000000, maxInteger=np.iinfo(np.int64).max):
+    """
+    return basis (minimum integer) IFN of ideal flow matrix F as int64 array
+    (scipy sparse int64 matrix if F is sparse) and its global scaling
+    (see globalScaling 'int'). Each link flow is numerator * (scaling // denominator)
+    of its fraction, exact in int64.
+    Raise ValueError if the scaling or a link flow exceeds maxInteger
+    (None or a bound above the int64 range = the largest int64)
+    """
+    int64Max = int(np.iinfo(np.int64).max)
+    maxInteger = int64Max if maxInteger is None else min(int(maxInteger), int64Max)
+    isSparse = sparse.issparse(F)
+    if isSparse:
+        F = sparse.csr_matrix(F, dtype=np.float64)
+        F.eliminate_zeros()
+        f = F.data
+    else:
+        F = np.asarray(F, dtype=np.float64)
+        f = F[F != 0]
+    numerators, denominators = rationalApproximation(f, maxDenominator)
+    scaling = lcmReduce(denominators, maxInteger)
+    factor = scaling // denominators
+    if np.any(np.abs(numerators) > maxInteger // factor):
+        raise ValueError("integer flow exceeds " + str(maxInteger))
+    flows = numerators * factor
+    if isSparse:
+        N = sparse.csr_matrix((flows, F.indices.copy(), F.indptr.copy()), shape=F.shape)
+    else:
+        N = np.zeros(F.shape, dtype=np.int64)
+        N[F != 0] = flows
+    return N, scaling
+
+
 if __name__ == '__main__':
     C = [[0, 1, 1, 1, 0],  # a
          [0, 0, 0, 1, 0],  # b
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+benchmark.py
+v0.1
+
+benchmark of the Markov solvers of IdealFlowNetwork.py
+on the sample networks and on synthetic grid networks
+IFN-Transport: application of Ideal Flow Network for Transportation Network
+
+usage: python benchmark.py [grid size ...]
+
+@author: Kardi Teknomo
+http://people.revoledu.com/kardi/
+"""
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+from scipy import sparse
+import IdealFlowNetwork as ifn
+
+
+def sampleCapacity(fileName):
+    """
+    return sparse capacity matrix of a link file
+    LinkID,Node1,Node2,Capacity,...
+    """
+    dfLink = pd.read_csv(fileName)
+    nodeIds = np.union1d(dfLink.Node1, dfLink.Node2)
+    r = np.searchsorted(nodeIds, dfLink.Node1.values)
+    c = np.searchsorted(nodeIds, dfLink.Node2.values)
+    n = len(nodeIds)
+    return sparse.csr_matrix((dfLink.Capacity.values.astype(np.float64), (r, c)), shape=(n, n))
+
+
+def gridCapacity(k, seed=0):
+    """
+    return sparse capacity matrix of a two-way k x k grid network
+    with random capacity of 1000 to 4000 per link
+    and the node coordinates x, y
+    """
+    rng = np.random.default_rng(seed)
+    idx = np.arange(k * k).reshape(k, k)
+    u = np.concatenate([idx[:, :-1].ravel(), idx[:, 1:].ravel(), idx[:-1, :].ravel(), idx[1:, :].ravel()])
+    v = np.concatenate([idx[:, 1:].ravel(), idx[:, :-1].ravel(), idx[1:, :].ravel(), idx[:-1, :].ravel()])
+    capacity = rng.integers(1, 5, len(u)) * 1000.0
+    C = sparse.csr_matrix((capacity, (u, v)), shape=(k * k, k * k))
+    return C, (idx % k).ravel(), (idx // k).ravel()
+
+
+def benchmark(name, C, x=None, y=None, maxDense=3000):
+    """
+    print time, iterations and residual of each Markov solver
+    relative to the sparse direct solver
+    """
+    S = ifn.capacity2stochastic(sparse.csr_matrix(C))
+    n = S.shape[0]
+    if not ifn.isIrreducible(S):
+        print(name, "is not strongly connected, skipped")
+        return
+    print("\n" + name, "nodes =", n, "links =", S.nnz)
+    solvers = []
+    if n <= maxDense:
+        solvers.append(("dense", lambda: (ifn.markov(S.toarray()), {})))
+    solvers.append(("sparse", lambda: (ifn.sparseMarkov(S), {})))
+    solvers.append(("power", lambda: ifn.powerMarkov(S, maxIter=20000)))
+    solvers.append(("multilevel", lambda: ifn.multilevelMarkov(S)))
+    if x is not None and n > 1000:
+        parts = ifn.coordinatePartition(x, y, 8)
+        solvers.append(("partition", lambda: ifn.partitionMarkov(S, parts)))
+    piRef = None
+    for solverName, solve in solvers:
+        start = time.time()
+        pi, info = solve()
+        elapsed = time.time() - start
+        pi = np.ravel(pi)
+        if piRef is None:
+            piRef = pi
+        error = np.max(np.abs(pi - piRef)) / np.max(piRef)
+        print("  {:<12}{:>10.4f} s  iterations = {:<8}residual = {:.2e}  error = {:.2e}".format(
+            solverName, elapsed, str(info.get('iterations', '-')), ifn.markovResidual(S, pi), error))
+        if solverName == "multilevel":
+            # warm start from a perturbed solution, as from a previous scenario
+            rng = np.random.default_rng(0)
+            pi0 = pi * (1 + 0.01 * rng.random(n))
+            start = time.time()
+            pi, info = ifn.multilevelMarkov(S, pi0=pi0)
+            elapsed = time.time() - start
+            print("  {:<12}{:>10.4f} s  iterations = {:<8}residual = {:.2e}".format(
+                "warm start", elapsed, str(info['iterations']), info['residual']))
+
+
+if __name__ == '__main__':
+    sampleFolder = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "sample")
+    for folder in sorted(os.listdir(sampleFolder)):
+        fileName = os.path.join(sampleFolder, folder, "Link.txt")
+        if os.path.exists(fileName):
+            benchmark(folder, sampleCapacity(fileName))
+    sizes = [int(arg) for arg in sys.argv[1:]] or [30, 100, 300]
+    for k in sizes:
+        C, x, y = gridCapacity(k)
+        benchmark("grid " + str(k) + "x" + str(k), C, x, y)
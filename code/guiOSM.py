@@ -20,6 +20,7 @@ import guiTable
 import pandas as pd
 
 osm = osm2ifn2.OSM2IFN()
+CACHE_FILE_NAME = 'graph.npz'  # binary network cache in scenario folder
 
 
 def gui():
@@ -252,7 +253,7 @@ def gui():
 
 def download_save_network(values, window, isImpute=True):
     """
-    get network and save as graph.graphml and 
+    get network and save as binary cache graph.npz and
     nodes.csv and links.csv
     in scenario folder as cache
 
@@ -264,7 +265,8 @@ def download_save_network(values, window, isImpute=True):
 
     Returns:
     ----------
-    graph.graphml and
+    G = downloaded network, False if it failed
+    graph.npz and
     nodes.csv and links.csv
     in scenario folder
     """
@@ -273,19 +275,23 @@ def download_save_network(values, window, isImpute=True):
         if isImpute:
             G = osm.imputeEdgesAttributes(G)
         scenarioFolder = values['txtFolderName']
-        fileName = os.path.join(scenarioFolder, 'graph.graphml')
-        osm.saveNetwork(G, fileName)
+        fileName = os.path.join(scenarioFolder, CACHE_FILE_NAME)
+        osm.saveNetworkCache(G, fileName, settingsHash=get_settings_hash(values, isImpute))
         osm.graph2csv(G, folderpath=scenarioFolder)  # save as nodes.csv and edges.csv
         window['txtInfo'].update(
-            "Downloaded and save network as graph.graphml, nodes.csv and links.csv in scenario folder")
+            "Downloaded and save network as " + CACHE_FILE_NAME + ", nodes.csv and links.csv in scenario folder")
+        return G
     except Exception as err:
         window['txtInfo'].update("Error:" + str(err.args))
+        return False
 
 
 def display_network(values, window):
     """
-    display network from file graph.graphml in scenario folder
-    If files does not exist, save in the background graph.graphml and
+    display network from binary cache graph.npz in scenario folder
+    The cache is used only if it was made with the same download options
+    and imputation settings, otherwise the network is downloaded again
+    and saved in the background as graph.npz and
         nodes.csv and links.csv
         in scenario folder
 
@@ -306,14 +312,18 @@ def display_network(values, window):
         isGraph = values['chkShowAsGraph']
         isDigraph = values['chkShowAsDigraph']
         scenarioFolder = values['txtFolderName']
-        fileName = os.path.join(scenarioFolder, 'graph.graphml')
-        if os.path.exists(fileName):
-            # get from cache if exists
-            G = osm.loadNetwork(fileName)
-        else:
+        fileName = os.path.join(scenarioFolder, CACHE_FILE_NAME)
+        oldFileName = os.path.join(scenarioFolder, 'graph.graphml')
+        # get from cache if it exists and it is still valid (downloaded with or without imputation)
+        G = osm.loadNetworkCache(fileName, settingsHash=[get_settings_hash(values, isImpute=True),
+                                                         get_settings_hash(values, isImpute=False)])
+        if G is False and os.path.exists(oldFileName) and not os.path.exists(fileName):
+            # convert cache of the previous version once
+            G = osm.loadNetwork(oldFileName)
+            osm.saveNetworkCache(G, fileName, settingsHash=get_settings_hash(values, isImpute=True))
+        if G is False:
             # otherwise, download from OSM and save to cache
-            G = get_network(values, window)
-            download_save_network(values, window, isImpute=True)
+            G = download_save_network(values, window, isImpute=True)
         msg = "Showing network "
         if isGraph:
             msg = msg + "graph "
@@ -402,5 +412,20 @@ def get_road_type(values):
     return roadType
 
 
+def get_settings_hash(values, isImpute=True):
+    """
+    return hash of the download options in the gui
+    and the imputation settings to validate the network cache
+    """
+    if values['chkSetPlace']:
+        query = {'place': values['txtPlace']}
+    else:
+        query = {'bbox': get_bbox(values)}
+    return osm.settingsHash(network_type=get_road_type(values),
+                            isSimplify=values['chkSimplifyIntersection'],
+                            isLargestComponent=values['chkSCC'],
+                            isImpute=isImpute, **query)
+
+
 if __name__ == '__main__':
     gui()
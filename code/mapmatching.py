@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+mapmatching.py
+v0.1
+
+map matching of GPS points to the links of IFN network
+to produce real flow data (LinkID,Node1,Node2,ActualFlow)
+IFN-Transport: application of Ideal Flow Network for Transportation Network
+
+@author: Kardi Teknomo
+http://people.revoledu.com/kardi/
+"""
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+
+class MapMatching():
+    def __init__(self, dfNode, dfLink, step=None, isGeographic=None):
+        '''
+        spatial index of the link segments from node X, Y coordinates.
+        Each segment is sampled by points at most step apart (default: median link length)
+        in a KD-tree; a GPS point is matched to the nearest segment among the
+        segments of its nearest sample points.
+        isGeographic: coordinates in degrees are projected to meter
+            (default: True if all coordinates are within +-180)
+
+        Parameters
+        ----------
+        dfNode : pandas DataFrame with index NodeID and columns X, Y
+        dfLink : pandas DataFrame with index LinkID and columns Node1, Node2
+        '''
+        self.dfLink = dfLink
+        x, y = dfNode['X'].values.astype(float), dfNode['Y'].values.astype(float)
+        if isGeographic is None:
+            isGeographic = bool(np.all(np.abs(x) <= 180) and np.all(np.abs(y) <= 180))
+        self.isGeographic = isGeographic
+        if isGeographic:
+            # equirectangular projection around the network; latitude is the coordinate within +-90
+            self.isLatitudeX = bool(np.all(np.abs(x) <= 90) and not np.all(np.abs(y) <= 90))
+            latitude = x if self.isLatitudeX else y
+            self.latitude0 = np.radians(np.mean(latitude))
+
+        node1 = dfNode.reindex(dfLink['Node1'].values)
+        node2 = dfNode.reindex(dfLink['Node2'].values)
+        x1, y1 = self.project(node1['X'].values.astype(float), node1['Y'].values.astype(float))
+        x2, y2 = self.project(node2['X'].values.astype(float), node2['Y'].values.astype(float))
+        isValid = ~(np.isnan(x1) | np.isnan(y1) | np.isnan(x2) | np.isnan(y2))
+        if not np.all(isValid):
+            print(np.sum(~isValid), "links without node coordinates are not matched")
+        self.linkPosition = np.flatnonzero(isValid)  # segment -> row of dfLink
+        self.x1, self.y1 = x1[isValid], y1[isValid]
+        self.dx, self.dy = x2[isValid] - self.x1, y2[isValid] - self.y1
+        self.node1 = dfLink['Node1'].values[isValid]
+        self.node2 = dfLink['Node2'].values[isValid]
+
+        length = np.hypot(self.dx, self.dy)
+        if step is None:
+            step = np.median(length[length > 0]) if np.any(length > 0) else 1
+        self.step = step
+        numPoints = np.ceil(length / step).astype(np.int64) + 1
+        segment = np.repeat(np.arange(len(length)), numPoints)
+        first = np.repeat(np.cumsum(numPoints) - numPoints, numPoints)
+        t = (np.arange(len(segment)) - first) / np.repeat(np.maximum(numPoints - 1, 1), numPoints)
+        self.pointSegment = segment
+        self.tree = cKDTree(np.column_stack([self.x1[segment] + t * self.dx[segment],
+                                             self.y1[segment] + t * self.dy[segment]]))
+
+        # streaming state
+        self.counts = np.zeros(len(dfLink), dtype=np.int64)  # number of vehicles entering each link
+        self.lastLink = {}  # vehicle -> row of dfLink of its last matched link
+        self.numPoints = 0
+        self.numUnmatched = 0
+
+    def project(self, x, y):
+        '''
+        return projected coordinates (meter for geographic coordinates)
+        '''
+        if not self.isGeographic:
+            return np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        latitude, longitude = (x, y) if self.isLatitudeX else (y, x)
+        return (np.asarray(longitude, dtype=float) * 111320 * np.cos(self.latitude0),
+                np.asarray(latitude, dtype=float) * 110540)
+
+    def candidateSegments(self, x, y, k=8, heading=None, headingWeight=None):
+        '''
+        return k candidate segments of each point (N x k) and the distance to them.
+        heading = movement (N x 2, projected coordinates) of each point, e.g. to the next point:
+        the distance is increased by headingWeight * (1 - cos(angle to the segment)) / 2,
+        which separates the two directions of a two-way road
+        (default headingWeight: 20 m for geographic coordinates, step/2 otherwise)
+        '''
+        px, py = self.project(x, y)
+        px, py = np.atleast_1d(px), np.atleast_1d(py)
+        _, index = self.tree.query(np.column_stack([px, py]), k=k)
+        index = index.reshape(len(px), -1)
+        segment = self.pointSegment[np.minimum(index, len(self.pointSegment) - 1)]
+        # exact distance of the point to the segment
+        dx, dy = self.dx[segment], self.dy[segment]
+        length2 = dx ** 2 + dy ** 2
+        t = np.clip(np.divide((px[:, None] - self.x1[segment]) * dx + (py[:, None] - self.y1[segment]) * dy,
+                              length2, out=np.zeros_like(length2), where=length2 > 0), 0, 1)
+        distance = np.hypot(px[:, None] - self.x1[segment] - t * dx, py[:, None] - self.y1[segment] - t * dy)
+        if heading is not None:
+            if headingWeight is None:
+                headingWeight = 20.0 if self.isGeographic else self.step / 2
+            hx, hy = heading[:, 0][:, None], heading[:, 1][:, None]
+            norm = np.hypot(hx, hy) * np.sqrt(length2)
+            cosine = np.divide(hx * dx + hy * dy, norm, out=np.ones_like(length2), where=norm > 0)
+            distance = distance + headingWeight * (1 - cosine) / 2
+        return segment, distance
+
+    def nearestLink(self, x, y, k=8, maxDistance=np.inf, heading=None):
+        '''
+        return row of dfLink of the nearest link of each point (-1 if farther than maxDistance)
+        and the distance (meter for geographic coordinates, including the heading term if any)
+        '''
+        segment, distance = self.candidateSegments(x, y, k, heading)
+        best = np.argmin(distance, axis=1)
+        rows = np.arange(len(best))
+        nearest = self.linkPosition[segment[rows, best]]
+        distance = distance[rows, best]
+        return np.where(distance <= maxDistance, nearest, -1), distance
+
+    def matchSequence(self, x, y, k=4, sigma=None, maxDistance=np.inf, turnPenalty=1.0, jumpPenalty=10.0,
+                      heading=None):
+        '''
+        return row of dfLink of the matched link of each point of one trajectory
+        (in time order) by hidden Markov model (Viterbi) over k candidate links per point:
+        the log likelihood of a point on a link is -(distance/sigma)^2/2,
+        staying on the same link costs nothing, moving to a link that starts at
+        the end of the previous link costs turnPenalty and any other move jumpPenalty.
+        sigma = GPS error (default: 10 m for geographic coordinates, step/4 otherwise)
+        heading = movement of each point (see candidateSegments)
+        '''
+        segment, distance = self.candidateSegments(x, y, k, heading)
+        if sigma is None:
+            sigma = 10.0 if self.isGeographic else self.step / 4
+        emission = -0.5 * (distance / sigma) ** 2
+        emission[distance > maxDistance] = -np.inf
+        T = len(segment)
+        if T == 0:
+            return np.array([], dtype=np.int64)
+        score = emission[0]
+        back = np.zeros((T, segment.shape[1]), dtype=np.int64)
+        for t in range(1, T):
+            previous, current = segment[t - 1], segment[t]
+            transition = np.where(previous[:, None] == current[None, :], 0.0,
+                                  np.where(self.node2[previous][:, None] == self.node1[current][None, :],
+                                           -turnPenalty, -jumpPenalty))
+            total = score[:, None] + transition
+            back[t] = np.argmax(total, axis=0)
+            score = total[back[t], np.arange(len(current))] + emission[t]
+        state = np.empty(T, dtype=np.int64)
+        state[-1] = np.argmax(score)
+        for t in range(T - 1, 0, -1):
+            state[t - 1] = back[t, state[t]]
+        matched = self.linkPosition[segment[np.arange(T), state]]
+        isMatched = np.isfinite(emission[np.arange(T), state])
+        return np.where(isMatched, matched, -1)
+
+    def addPoints(self, vehicle, x, y, isHMM=False, k=8, maxDistance=np.inf):
+        '''
+        match a chunk of GPS points and add the number of vehicles entering each link.
+        The points of each vehicle must be in time order, within the chunk and
+        over the chunks (the last matched link of each vehicle is kept between chunks).
+        isHMM: match the points of each vehicle by matchSequence instead of nearest link
+        '''
+        vehicle = np.asarray(vehicle)
+        order = np.argsort(vehicle, kind='stable')
+        vehicle = vehicle[order]
+        x, y = np.asarray(x, dtype=float)[order], np.asarray(y, dtype=float)[order]
+        isStart = np.concatenate([[True], vehicle[1:] != vehicle[:-1]]) if len(vehicle) else np.array([], bool)
+        isEnd = np.append(vehicle[1:] != vehicle[:-1], True) if len(vehicle) else np.array([], bool)
+        # heading from the previous to the next point of the same vehicle
+        px, py = self.project(x, y)
+        nextIndex = np.where(isEnd, np.arange(len(vehicle)), np.arange(len(vehicle)) + 1)
+        previousIndex = np.where(isStart, np.arange(len(vehicle)), np.arange(len(vehicle)) - 1)
+        heading = np.column_stack([px[nextIndex] - px[previousIndex], py[nextIndex] - py[previousIndex]])
+        if isHMM:
+            starts = np.append(np.flatnonzero(isStart), len(vehicle))
+            link = np.concatenate([self.matchSequence(x[a:b], y[a:b], k=k, maxDistance=maxDistance,
+                                                      heading=heading[a:b])
+                                   for a, b in zip(starts[:-1], starts[1:])]) if len(vehicle) else \
+                np.array([], dtype=np.int64)
+        else:
+            link, _ = self.nearestLink(x, y, k=k, maxDistance=maxDistance, heading=heading)
+        self.numPoints += len(link)
+        isMatched = link >= 0
+        self.numUnmatched += int(np.sum(~isMatched))
+        vehicle, link = vehicle[isMatched], link[isMatched]
+        if len(link) == 0:
+            return
+
+        # a vehicle enters a link when its matched link changes
+        isStart = np.concatenate([[True], vehicle[1:] != vehicle[:-1]])
+        previous = np.concatenate([[-1], link[:-1]])
+        previous[isStart] = pd.Series(self.lastLink, dtype=float).reindex(vehicle[isStart]).fillna(-1).values
+        isEntry = link != previous
+        self.counts += np.bincount(link[isEntry], minlength=len(self.counts))
+        isLast = np.append(vehicle[1:] != vehicle[:-1], True)
+        self.lastLink.update(zip(vehicle[isLast].tolist(), link[isLast].tolist()))
+
+    def matchFile(self, file_name, chunkSize=1000000, vehicle='VehicleID', time=None, isHMM=False, k=8,
+                  maxDistance=np.inf):
+        '''
+        stream a GPS file (csv with columns vehicle, X, Y and optionally time,
+        in time order) through addPoints in chunks of chunkSize points
+        '''
+        for chunk in pd.read_csv(file_name, chunksize=chunkSize):
+            if time is not None:
+                chunk = chunk.sort_values([vehicle, time], kind='stable')
+            self.addPoints(chunk[vehicle].values, chunk['X'].values, chunk['Y'].values,
+                           isHMM=isHMM, k=k, maxDistance=maxDistance)
+
+    def realFlow(self, scaling=1.0, isObservedOnly=True):
+        '''
+        return pandas DataFrame of real flow (index LinkID, Node1, Node2, ActualFlow)
+        ActualFlow = scaling * number of vehicles entering the link
+        (e.g. scaling = 1/number of hours for flow per hour)
+        '''
+        dfFlow = pd.DataFrame({'Node1': self.dfLink['Node1'].values,
+                               'Node2': self.dfLink['Node2'].values,
+                               'ActualFlow': self.counts * scaling},
+                              index=pd.Index(self.dfLink.index.values, name='LinkID'))
+        if isObservedOnly:
+            dfFlow = dfFlow[self.counts > 0]
+        return dfFlow
+
+    def saveRealFlow(self, file_name, scaling=1.0):
+        '''
+        save the real flow in the format of RealFlow.txt
+        '''
+        self.realFlow(scaling).to_csv(file_name)
+        print(self.numPoints, "points,", self.numUnmatched, "not matched, real flow saved in", file_name)
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+onlinecalibration.py
+v0.1
+
+online calibration of the scaling factor of a scenario from streaming traffic counts
+(file tail or local socket), without solving the Markov chain again
+IFN-Transport: application of Ideal Flow Network for Transportation Network
+
+usage:
+    scn = Scenario("scenario-0", dict_scenario, folder_path)  # the scenario is run when created
+    online = OnlineCalibration(scn, half_life=3600)
+    for scaling in online.track(online.followFile("counts.csv")):
+        print(scaling, online.scn.dfLink.Congestion.max())
+
+@author: Kardi Teknomo
+http://people.revoledu.com/kardi/
+"""
+import io
+import os
+import socket
+import time
+import numpy as np
+import pandas as pd
+import IdealFlowNetwork as ifn
+
+
+class OnlineCalibration():
+    def __init__(self, scn, forgetting=1.0, half_life=None, criterion='SSE'):
+        '''
+        least squares scaling factor of the basis flow of the scenario to the counts,
+        updated from the sufficient statistics sum(w*flow*basis), sum(w*basis^2), sum(w*flow^2)
+        of all count batches, the old batches are discounted by exponential forgetting:
+        every update multiplies the statistics by forgetting (1 = no forgetting)
+        or by 0.5^(elapsed time / half_life) if half_life (in the unit of Time) is given
+        and the batches have Time.
+
+        Parameters
+        ----------
+        scn : Scenario that has been run (BasisFlow in dfLink)
+        criterion : 'SSE' (equal weight) or 'WLS' (weight 1/count)
+        '''
+        if scn.dfLink is None or "BasisFlow" not in scn.dfLink:
+            raise ValueError("Run the scenario before the online calibration.")
+        if criterion not in ('SSE', 'R^2', 'WLS'):
+            raise ValueError("online calibration supports the least squares criteria SSE, R^2 and WLS")
+        self.scn = scn
+        self.forgetting = forgetting
+        self.half_life = half_life
+        self.criterion = criterion
+        self.basis = scn.dfLink['BasisFlow'].values.astype(float)
+        self.capacity = scn.dfLink['Capacity'].values.astype(float)
+
+        # sufficient statistics
+        self.sumFB = 0.0
+        self.sumBB = 0.0
+        self.sumFF = 0.0
+        self.sumW = 0.0  # effective number of counts
+        self.lastTime = None
+        self.scaling = scn.scalingFactor if scn.scalingFactor else scn.kappa
+        self.observed = np.full(len(self.basis), np.nan)  # latest count of each link
+        self.numUpdates = 0
+        self.numUnmatched = 0
+
+    def update(self, linkIds, flows, times=None, weights=None):
+        '''
+        add a batch of counts (LinkID and flow of each count) and
+        return the updated scaling factor. Counts of unknown LinkID are ignored.
+        times = time of the counts (the latest is the time of the batch)
+        '''
+        position = self.scn.dfLink.index.get_indexer(np.asarray(linkIds))
+        flows = np.asarray(flows, dtype=float)
+        isValid = (position >= 0) & np.isfinite(flows)
+        self.numUnmatched += int(np.sum(~isValid))
+        position, flows = position[isValid], flows[isValid]
+        if weights is not None:
+            weights = np.asarray(weights, dtype=float)[isValid]
+        elif self.criterion == 'WLS':
+            weights = 1 / np.maximum(flows, 1)
+        else:
+            weights = np.ones(len(flows))
+
+        # exponential forgetting of the previous batches
+        decay = self.forgetting
+        if self.half_life is not None and times is not None and len(times) > 0:
+            batchTime = np.max(times)
+            if self.lastTime is not None:
+                decay = 0.5 ** (max(batchTime - self.lastTime, 0) / self.half_life)
+            self.lastTime = batchTime
+        basis = self.basis[position]
+        self.sumFB = decay * self.sumFB + np.sum(weights * flows * basis)
+        self.sumBB = decay * self.sumBB + np.sum(weights * basis ** 2)
+        self.sumFF = decay * self.sumFF + np.sum(weights * flows ** 2)
+        self.sumW = decay * self.sumW + np.sum(weights)
+        self.observed[position] = flows
+        if self.sumBB > 0:
+            self.scaling = self.sumFB / self.sumBB
+        self.numUpdates += 1
+        return self.scaling
+
+    def refresh(self):
+        '''
+        update EstFlow, Congestion and the link performance of the scenario
+        at the current scaling factor (elementwise over the links)
+        '''
+        scn = self.scn
+        scn.scalingFactor = self.scaling
+        scn.kappa = self.scaling
+        scn.dfLink['EstFlow'] = self.scaling * self.basis
+        scn.dfLink['Congestion'] = ifn.hadamardDivision(scn.dfLink['EstFlow'].values, self.capacity)
+        scn.computeLinkPerformance()
+
+    def weightedSSE(self):
+        '''
+        return the discounted weighted sum of squared error of all batches at the current scaling factor
+        '''
+        return max(self.sumFF - 2 * self.scaling * self.sumFB + self.scaling ** 2 * self.sumBB, 0)
+
+    def goodnessOfFit(self):
+        '''
+        return goodness of fit (see ifn.goodnessOfFit) of the latest count of each counted link
+        '''
+        isCounted = np.isfinite(self.observed)
+        return ifn.goodnessOfFit(self.scaling * self.basis[isCounted], self.observed[isCounted])
+
+    def track(self, batches, isRefresh=True):
+        '''
+        update (and refresh) for each batch of counts (DataFrame with LinkID, ActualFlow
+        and optionally Time, Weight) and yield the scaling factor
+        '''
+        for dfBatch in batches:
+            if 'LinkID' not in dfBatch:
+                dfBatch = dfBatch.reset_index()
+            self.update(dfBatch['LinkID'].values, dfBatch['ActualFlow'].values,
+                        dfBatch['Time'].values if 'Time' in dfBatch else None,
+                        dfBatch['Weight'].values if 'Weight' in dfBatch else None)
+            if isRefresh:
+                self.refresh()
+            yield self.scaling
+
+    @staticmethod
+    def followFile(file_name, interval=5.0, timeout=None, isFromStart=True):
+        '''
+        yield the new lines appended to a count file (csv with header LinkID,ActualFlow[,Time,Weight])
+        as DataFrame batches, checking every interval seconds;
+        stop after timeout seconds without new line (None = follow forever)
+        isFromStart: the lines already in the file are the first batch
+        '''
+        with open(file_name, 'r') as f:
+            header = f.readline()
+            if not isFromStart:
+                f.seek(0, os.SEEK_END)
+            buffer = ""
+            idle = 0.0
+            while timeout is None or idle < timeout:
+                buffer += f.read()
+                complete, _, buffer = buffer.rpartition("\n")
+                if complete.strip():
+                    idle = 0.0
+                    yield pd.read_csv(io.StringIO(header + complete + "\n"))
+                else:
+                    time.sleep(interval)
+                    idle += interval
+
+    @staticmethod
+    def listenSocket(host='127.0.0.1', port=5005, header="LinkID,ActualFlow", timeout=None):
+        '''
+        yield the count batches sent to a local TCP socket as DataFrame:
+        csv lines in the columns of header, a batch ends at an empty line
+        or when the sender closes the connection.
+        stop after timeout seconds without connection (None = listen forever)
+        '''
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind((host, port))
+            server.listen(1)
+            server.settimeout(timeout)
+            while True:
+                try:
+                    connection, _ = server.accept()
+                except socket.timeout:
+                    return
+                with connection, connection.makefile('r') as stream:
+                    lines = []
+                    for line in stream:
+                        if line.strip():
+                            lines.append(line)
+                        elif lines:
+                            yield pd.read_csv(io.StringIO(header + "\n" + "".join(lines)))
+                            lines = []
+                    if lines:
+                        yield pd.read_csv(io.StringIO(header + "\n" + "".join(lines)))
@@ -10,6 +10,8 @@ import branca
 import matplotlib.colors as mcolors
 import json
 import os
+import hashlib
+from shapely.geometry import LineString
 
 class OSM2IFN():
     def __init__(self):
@@ -461,6 +463,193 @@ class OSM2IFN():
         G = ox.load_graphml(filepath)
         return G
 
+    def settingsHash(self, **options):
+        """
+        return hash of the download options and the imputation settings
+        used to invalidate the binary network cache
+
+        Parameters
+        ----------
+        options = keyword arguments of the download query,
+                  e.g. place, bbox, network_type, isSimplify, isImpute
+
+        Returns
+        -------
+            hexadecimal string
+        """
+        h = hashlib.sha1()
+        h.update(json.dumps(options, sort_keys=True, default=str).encode('utf-8'))
+        if options.get('isImpute', False) and os.path.exists('settings.json'):
+            with open('settings.json', 'rb') as file:
+                h.update(file.read())
+        return h.hexdigest()
+
+    def saveNetworkCache(self, G, filepath, settingsHash=""):
+        """
+        save graph into a compact binary cache (numpy .npz)
+        nodes and edges are stored as arrays, attributes as columns
+        and edge geometry as packed coordinates
+
+        Parameters
+        ----------
+        G = osmnx MultiDiGraph
+        filepath = cache file name (.npz)
+        settingsHash = string from settingsHash()
+        """
+        nodeIds = list(G.nodes())
+        nodeIndex = {node: idx for idx, node in enumerate(nodeIds)}
+        arrays = {}
+        if all(isinstance(node, (int, np.integer)) for node in nodeIds):
+            arrays['node_id'] = np.array(nodeIds, dtype=np.int64)
+        else:
+            arrays['node_id'] = np.array([str(node) for node in nodeIds])
+
+        # node attribute columns
+        nodeData = [data for _, data in G.nodes(data=True)]
+        nodeColumns = {}
+        for name in sorted({key for data in nodeData for key in data}):
+            kind, values, present = self.__encodeColumn([data.get(name) for data in nodeData])
+            arrays['node:' + name + ':values'] = values
+            arrays['node:' + name + ':present'] = present
+            nodeColumns[name] = kind
+
+        # edge arrays, edge attribute columns and packed geometry
+        edgeU, edgeV, edgeKey, edgeData = [], [], [], []
+        for u, v, key, data in G.edges(keys=True, data=True):
+            edgeU.append(nodeIndex[u])
+            edgeV.append(nodeIndex[v])
+            edgeKey.append(key)
+            edgeData.append(data)
+        arrays['edge_u'] = np.array(edgeU, dtype=np.int64)
+        arrays['edge_v'] = np.array(edgeV, dtype=np.int64)
+        arrays['edge_key'] = np.array(edgeKey, dtype=np.int64)
+        geomOffsets = np.zeros(len(edgeData) + 1, dtype=np.int64)
+        geomCoords = []
+        for idx, data in enumerate(edgeData):
+            geometry = data.get('geometry')
+            coords = list(geometry.coords) if geometry is not None else []
+            geomCoords.extend(coords)
+            geomOffsets[idx + 1] = geomOffsets[idx] + len(coords)
+        arrays['edge_geometry_offsets'] = geomOffsets
+        arrays['edge_geometry_coords'] = np.array(geomCoords, dtype=np.float64).reshape(-1, 2)
+        edgeColumns = {}
+        for name in sorted({key for data in edgeData for key in data if key != 'geometry'}):
+            kind, values, present = self.__encodeColumn([data.get(name) for data in edgeData])
+            arrays['edge:' + name + ':values'] = values
+            arrays['edge:' + name + ':present'] = present
+            edgeColumns[name] = kind
+
+        header = {'version': 1,
+                  'settings_hash': settingsHash,
+                  'content_hash': self.__arraysHash(arrays),
+                  'graph': G.graph,
+                  'node_columns': nodeColumns,
+                  'edge_columns': edgeColumns}
+        arrays['header'] = np.array(json.dumps(header, default=str))
+        with open(filepath, 'wb') as file:
+            np.savez(file, **arrays)
+
+    def loadNetworkCache(self, filepath, settingsHash=None):
+        """
+        load graph from binary cache created by saveNetworkCache()
+
+        Parameters
+        ----------
+        filepath = cache file name (.npz)
+        settingsHash = expected string (or list of strings) from settingsHash();
+                       None accepts any settings
+
+        Returns
+        -------
+            osmnx MultiDiGraph, or False if the cache does not exist,
+            is corrupted or was made with different settings
+        """
+        if not os.path.exists(filepath):
+            return False
+        try:
+            with np.load(filepath, allow_pickle=False) as npz:
+                arrays = {key: npz[key] for key in npz.files}
+            header = json.loads(str(arrays.pop('header')))
+        except Exception as err:
+            print("Error:" + str(err.args) + '\nThe network cache cannot be read')
+            return False
+        if settingsHash is not None:
+            if isinstance(settingsHash, str):
+                settingsHash = [settingsHash]
+            if header['settings_hash'] not in settingsHash:
+                return False
+        if header['content_hash'] != self.__arraysHash(arrays):
+            return False
+
+        nodeIds = arrays['node_id'].tolist()
+        nodeData = [{} for _ in nodeIds]
+        for name, kind in header['node_columns'].items():
+            self.__decodeColumn(nodeData, name, kind, arrays['node:' + name + ':values'],
+                                arrays['node:' + name + ':present'])
+        edgeU = arrays['edge_u'].tolist()
+        edgeV = arrays['edge_v'].tolist()
+        edgeKey = arrays['edge_key'].tolist()
+        edgeData = [{} for _ in edgeU]
+        for name, kind in header['edge_columns'].items():
+            self.__decodeColumn(edgeData, name, kind, arrays['edge:' + name + ':values'],
+                                arrays['edge:' + name + ':present'])
+        geomOffsets = arrays['edge_geometry_offsets']
+        geomCoords = arrays['edge_geometry_coords']
+        for idx in np.flatnonzero(np.diff(geomOffsets) > 0):
+            data = edgeData[idx]
+            data['geometry'] = LineString(geomCoords[geomOffsets[idx]:geomOffsets[idx + 1]])
+
+        G = nx.MultiDiGraph(**header['graph'])
+        G.add_nodes_from(zip(nodeIds, nodeData))
+        G.add_edges_from((nodeIds[u], nodeIds[v], key, data)
+                         for u, v, key, data in zip(edgeU, edgeV, edgeKey, edgeData))
+        return G
+
+    @staticmethod
+    def __arraysHash(arrays):
+        # content hash of the cached arrays (independent of key order)
+        h = hashlib.sha1()
+        for key in sorted(arrays):
+            if key == 'header':
+                continue
+            h.update(key.encode('utf-8'))
+            h.update(str(arrays[key].dtype).encode('utf-8'))
+            h.update(np.ascontiguousarray(arrays[key]).tobytes())
+        return h.hexdigest()
+
+    @staticmethod
+    def __encodeColumn(values):
+        # encode attribute column as (kind, values array, present mask)
+        present = np.array([value is not None for value in values], dtype=bool)
+        items = [value for value in values if value is not None]
+        if all(isinstance(value, (bool, np.bool_)) for value in items):
+            kind = 'bool'
+            arr = np.array([bool(value) if value is not None else False for value in values], dtype=bool)
+        elif all(isinstance(value, (int, np.integer)) and not isinstance(value, bool) for value in items):
+            kind = 'int'
+            arr = np.array([value if value is not None else 0 for value in values], dtype=np.int64)
+        elif all(isinstance(value, (int, float, np.integer, np.floating)) for value in items):
+            kind = 'float'
+            arr = np.array([value if value is not None else np.nan for value in values], dtype=np.float64)
+        elif all(isinstance(value, str) for value in items):
+            kind = 'str'
+            arr = np.array([value if value is not None else '' for value in values])
+        else:
+            # lists (e.g. osmid of simplified edges) and other objects
+            kind = 'json'
+            arr = np.array([json.dumps(value, default=str) if value is not None else '' for value in values])
+        return kind, arr, present
+
+    @staticmethod
+    def __decodeColumn(lstData, name, kind, arr, present):
+        # put attribute column back into list of attribute dictionaries
+        values = arr.tolist()
+        if kind == 'json':
+            values = [json.loads(value) if value else None for value in values]
+        for data, value, isPresent in zip(lstData, values, present.tolist()):
+            if isPresent:
+                data[name] = value
+
 
     # def graph2csv(self, G, folderpath=""):
     #     # Convert the graph to GeoDataFrames
@@ -515,6 +704,88 @@ class OSM2IFN():
         # G = nx.from_pandas_edgelist(edges, 'u', 'v', edge_attr=True, create_using=nx.MultiDiGraph())
         return G
 
+    def graph2ifn(self, G):
+        """
+        convert (imputed) graph directly into IFN node and link tables
+        without going through csv files.
+        Nodes are renumbered contiguously from 0 to n-1 and
+        parallel edges between the same pair of nodes are merged into one link:
+        capacity and number of lanes are summed, distance and max speed
+        are averaged with capacity as weight.
+
+        Parameters
+        ----------
+        G = osmnx MultiDiGraph after imputeEdgesAttributes()
+
+        Returns
+        -------
+        dfNode = DataFrame NodeID,X,Y,osmID (X=latitude, Y=longitude as in saveNodes)
+        dfLink = DataFrame LinkID,Node1,Node2,Capacity,Distance,MaxSpeed,NumLane,RoadType
+                 capacity in pcu/hour, distance in km, max speed in km/hour
+        """
+        osmIds = list(G.nodes())
+        nodeIndex = {node: idx for idx, node in enumerate(osmIds)}
+        n = len(osmIds)
+        lat = np.array([data.get('y', np.nan) for _, data in G.nodes(data=True)], dtype=np.float64)
+        lon = np.array([data.get('x', np.nan) for _, data in G.nodes(data=True)], dtype=np.float64)
+
+        m = G.number_of_edges()
+        node1 = np.empty(m, dtype=np.int64)
+        node2 = np.empty(m, dtype=np.int64)
+        capacity = np.empty(m, dtype=np.float64)
+        length = np.empty(m, dtype=np.float64)
+        maxSpeed = np.empty(m, dtype=np.float64)
+        lanes = np.empty(m, dtype=np.float64)
+        roadType = []
+        for j, (u, v, data) in enumerate(G.edges(data=True)):
+            node1[j] = nodeIndex[u]
+            node2[j] = nodeIndex[v]
+            capacity[j] = self.__toFloat(data.get('capacity'))
+            length[j] = self.__toFloat(data.get('length'))
+            maxSpeed[j] = self.__toFloat(data.get('computed_max_speed'))
+            lanes[j] = self.__toFloat(data.get('lanes'))
+            highway = data.get('highway', '')
+            roadType.append(highway[0] if isinstance(highway, list) else highway)
+        roadType = np.array(roadType, dtype=object)
+
+        # merge parallel edges (and drop self loops)
+        isLink = node1 != node2
+        pair, inverse = np.unique(node1[isLink] * n + node2[isLink], return_inverse=True)
+        weight = np.nan_to_num(capacity[isLink])
+        sumCapacity = np.bincount(inverse, weights=weight, minlength=len(pair))
+        sumWeight = np.where(sumCapacity > 0, sumCapacity, 1)
+        if np.any(sumCapacity == 0):
+            # no capacity on all parallel edges: simple average
+            weight = np.where(sumCapacity[inverse] > 0, weight, 1)
+            sumWeight = np.bincount(inverse, weights=weight, minlength=len(pair))
+        distance = np.bincount(inverse, weights=weight * length[isLink], minlength=len(pair)) / sumWeight
+        speed = np.bincount(inverse, weights=weight * maxSpeed[isLink], minlength=len(pair)) / sumWeight
+        numLane = np.bincount(inverse, weights=np.nan_to_num(lanes[isLink]), minlength=len(pair))
+        # road type of the parallel edge with the largest capacity
+        order = np.lexsort((-capacity[isLink], inverse))
+        first = order[np.r_[True, inverse[order][1:] != inverse[order][:-1]]]
+
+        dfNode = pd.DataFrame({'NodeID': np.arange(n), 'X': lat, 'Y': lon, 'osmID': osmIds}).set_index('NodeID')
+        dfLink = pd.DataFrame({'LinkID': np.arange(1, len(pair) + 1),
+                               'Node1': pair // n,
+                               'Node2': pair % n,
+                               'Capacity': sumCapacity,
+                               'Distance': distance / 1000,  # m to km
+                               'MaxSpeed': speed,
+                               'NumLane': numLane,
+                               'RoadType': roadType[isLink][first]}).set_index('LinkID')
+        return dfNode, dfLink
+
+    @staticmethod
+    def __toFloat(value, default=np.nan):
+        # attribute value from osmnx or graphml (number, string or list) to float
+        if isinstance(value, list):
+            value = value[0] if len(value) > 0 else None
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return default
+
 
 
 def readCSVFileSkipOneRow(fileName):
@@ -18,6 +18,15 @@ import json
 import csv
 import networkx as nx
 import math
+import hashlib
+import warnings
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.sparse import linalg as splinalg
+from scipy.spatial import cKDTree
+from concurrent.futures import ThreadPoolExecutor
+from matplotlib.path import Path
+from mapmatching import MapMatching
 
 
 class Project():
@@ -40,8 +49,11 @@ class Project():
     def run_scenarios(self):
         # extract and run each scenario
         self.scenarios = self.extract_scenarios()
+        warm_start = None
         for scn_id, dict_scenario in self.scenarios.items():
-            scn = Scenario(scn_id, dict_scenario, self.folder_path)
+            scn = Scenario(scn_id, dict_scenario, self.folder_path, warm_start)
+            if scn.pi is not None:
+                warm_start = scn.pi  # Markov vector of the previous scenario starts the iterative solvers
             # scn.run_scenario()
             print(scn, '\n')
 
@@ -60,7 +72,7 @@ class Project():
 
 
 class Scenario():
-    def __init__(self, id, dict_scenario, folder_path):
+    def __init__(self, id, dict_scenario, folder_path, warm_start=None):
         self.dfLink = None
         self.nodeIds = None
         self.id = id  # scenario id
@@ -82,13 +94,36 @@ class Scenario():
                 {'total-flow': 15000},              # for "total-flow"
                 {'criterion':'SSE'},                # for "real-flow"
                 {'criterion': 'R^2'}                # for "real-flow"
+                {'criterion': 'GEH'}                # for "real-flow": also 'WLS', 'L1', 'huber' (see
+                                                    # ifn.calibrationObjectives), optional 'weight' (column of
+                                                    # the real flow file) and 'delta' (for 'huber')
+                {'capacity': 'link', 'regularization': 0.01}  # for "real-flow": calibrate the capacity of each link
+                {'capacity': 'RoadType', 'bounds': [0.1, 10]} # or one capacity multiplier per value of a link field
+                {'resample': {'samples': 1000, 'station': 'StationID', 'level': 0.95, 'workers': 4}}
+                                                    # for "real-flow": bootstrap and leave-one-station-out
         """
         self.total_flow = None
         self.max_allowable_congestion = None
+        self.solver = "dense"  # "dense", "sparse", "partition", "multilevel" or "power" to compute the Markov vector
+        self.solver_parameters = {}  # {"blocks": 8, "workers": 4, "partition": "coordinate"} for "partition"
+        # {"tolerance": 1e-10, "max-iteration": 100} for "multilevel" or "power"
+        self.warm_start = warm_start  # pandas Series of initial Markov vector indexed by node id
+        self.pi = None  # pandas Series of Markov vector (kappa=1) indexed by node id
         self.data = None  # {"flow": "file path of real world flow data"}
+        self.uncertainty = None  # {"draws": 1000, "distribution": "lognormal", "cv": 0.2, ...} for Monte Carlo capacity
+        self.equilibrium = None  # {"theta": 60, "max-iteration": 100, "tolerance": 1e-4} for stochastic equilibrium
+        self.periods = None  # list of {"name": "07:00", "total-flow": 15000, "capacity": {"LinkID": capacity}}
+        self.network_coupling = "block"  # "block": independent networks, "coupled": networks joined by shared NodeID
+        self.classes = None  # {"car": {"pcu": 1, "share": 0.4}, "truck": {"pcu": 2.5, "share": 0.1, "exclude-road-type": [...]}}
+        self.origins = None  # list of NodeID for the origin decomposition of the flow
+        self.skim = None  # {"zones": [NodeID, ...], "field": "TravelTime"} for travel time skim
+        self.trajectory = None  # {"walks": 10000, "steps": 100, "seed": 0} for random walk trajectories
+        self.sensitivity = None  # {"outputs": ["max-congestion", "total-delay"], "links": [LinkID, ...]} for gradients
 
         # initialize internal state values
         self.scalingFactor = 0
+        self.calibration_fit = None  # goodness of fit of the real flow calibration (see ifn.goodnessOfFit)
+        self.kappa = None  # total flow of the calibrated scenario
 
         # initial run: parse dictionary into internal values
         self.parse_scenario()
@@ -105,6 +140,7 @@ class Scenario():
             "\ncalibration_parameter = " + str(self.calibration_parameter) + \
             "\ntotal_flow = " + str(self.total_flow) + \
             "\nmax_allowable_congestion = " + str(self.max_allowable_congestion) + \
+            "\nsolver = " + str(self.solver) + \
             "\ndata = " + str(self.data)
 
     def run_scenario(self):
@@ -161,6 +197,39 @@ class Scenario():
             if "travel-cost-parameters" in self.model:
                 self.travel_cost_model_parameters = self.model["travel-cost-parameters"]
 
+            if "solver" in self.model:
+                self.solver = self.model["solver"]
+
+            if "solver-parameters" in self.model:
+                self.solver_parameters = self.model["solver-parameters"]
+
+            if "uncertainty" in self.model:
+                self.uncertainty = self.model["uncertainty"]
+
+            if "equilibrium" in self.model:
+                self.equilibrium = self.model["equilibrium"]
+
+            if "periods" in self.model:
+                self.periods = self.model["periods"]
+
+            if "network-coupling" in self.model:
+                self.network_coupling = self.model["network-coupling"]
+
+            if "classes" in self.model:
+                self.classes = self.model["classes"]
+
+            if "origins" in self.model:
+                self.origins = self.model["origins"]
+
+            if "skim" in self.model:
+                self.skim = self.model["skim"]
+
+            if "trajectory" in self.model:
+                self.trajectory = self.model["trajectory"]
+
+            if "sensitivity" in self.model:
+                self.sensitivity = self.model["sensitivity"]
+
             if "calibration" in self.model:
                 self.calibration = self.model["calibration"]
 
@@ -175,19 +244,56 @@ class Scenario():
                     if "max-allowable-congestion" in self.calibration_parameter:
                         self.max_allowable_congestion = self.calibration_parameter["max-allowable-congestion"]
 
+    def analysisKeys(self):
+        """
+        return the model keys of the analyses after the scenario run that are requested
+        (they are based on the link table of one network)
+        """
+        analyses = {"uncertainty": self.uncertainty, "skim": self.skim, "trajectory": self.trajectory,
+                    "origins": self.origins, "periods": self.periods, "equilibrium": self.equilibrium,
+                    "sensitivity": self.sensitivity}
+        return [key for key, value in analyses.items() if value is not None]
+
     def runScenario(self):
-        C = self.mLink2WeightedAdjacency(field='Capacity')  # capacity
-        S = ifn.capacity2stochastic(C)  # Markov stochastic
+        if len(self.networks) > 1:
+            if self.analysisKeys():
+                raise ValueError("model keys " + ", ".join(self.analysisKeys()) +
+                                 " are not available for a scenario of several networks")
+            return self.runNetworks()
+        if self.classes is not None:
+            if self.analysisKeys():
+                raise ValueError("model keys " + ", ".join(self.analysisKeys()) +
+                                 " are not available for a scenario of vehicle classes")
+            return self.runClasses()
+        if self.calibration_basis == "real-flow" and "capacity" in (self.calibration_parameter or {}):
+            # the scenario is run with the calibrated capacity
+            if self.calibrateCapacity() is not None:
+                if "ImputedCapacity" not in self.dfLink:
+                    self.dfLink['ImputedCapacity'] = self.dfLink['Capacity']
+                self.dfLink['Capacity'] = self.dfLink['CalibratedCapacity']
+        isSparse = self.solver != "dense"
+        C = self.mLink2WeightedAdjacency(field='Capacity', isSparse=isSparse)  # capacity
+        if self.networks['network-0'].is_contract:
+            # link choice at the start of a chain is based on the capacity of its first link
+            S = ifn.capacity2stochastic(self.mLink2WeightedAdjacency(field='EntryCapacity', isSparse=isSparse))
+        else:
+            S = ifn.capacity2stochastic(C)  # Markov stochastic
         if not ifn.isIrreducible(S):
             print("Your network is not strongly connected. Clean the network data either by finding the largest "
                   "strongly connected component or add a cloud node and dummy links.")
             return None
 
         # first try at kappa=1
-        pi = ifn.markov(S, kappa=1)  # node values
+        pi = self.solveMarkov(S, kappa=1)  # node values
+        self.pi = pd.Series(np.ravel(pi), index=self.nodeIds)
         F = ifn.idealFlow(S, pi)  # ideal flow
+        if self.networks['network-0'].is_contract:
+            # every link of a chain carries the flow of its super-link: scale the basis flow
+            # such that it sums to one over the full network, thus kappa is the total flow
+            self.addField2dfLink(F, "BasisFlow")
+            F = F / np.sum(self.dfLink["BasisFlow"])
         G = ifn.hadamardDivision(F, C)  # congestion
-        maxCongestion = np.max(G)
+        maxCongestion = G.max()
 
         kappa = 1
         if self.calibration_basis == "total-flow":
@@ -197,10 +303,18 @@ class Scenario():
             # calibrate with new kappa to reach max congestion level
             kappa = float(self.max_allowable_congestion) / maxCongestion  # total flow
         elif self.calibration_basis == "real-flow":
+            self.addField2dfLink(F, "BasisFlow")
             self.find_optimum_scaling()
-            self.total_flow = np.sum(ifn.sumOfRow(F))
+            if "resample" in self.calibration_parameter:
+                resample = self.calibration_parameter["resample"]
+                self.resampleScaling(numSamples=resample.get("samples", 1000), station=resample.get("station"),
+                                     level=resample.get("level", 0.95), seed=resample.get("seed", 0),
+                                     workers=resample.get("workers", 1))
+            self.total_flow = np.sum(self.dfLink["BasisFlow"])
             kappa = self.total_flow*self.scalingFactor
 
+        self.kappa = kappa
+
         # compute ideal flow and congestion
         # scaling=ifn.globalScaling(F,'min',1)
         # F1=ifn.equivalentIFN(F, scaling)
@@ -208,13 +322,25 @@ class Scenario():
         # pi=ifn.markov(S,kappa)               # node values
         # F3=ifn.idealFlow(S,pi)               # scaled ideal flow
         G = ifn.hadamardDivision(F1, C)  # congestion
-        maxCongestion = np.max(G)
+        maxCongestion = G.max()
 
         # compute link performances
         self.addField2dfLink(G, 'Congestion')
         self.addField2dfLink(F, "BasisFlow")
         self.addField2dfLink(F1, "EstFlow")
+        if self.networks['network-0'].is_contract:
+            # congestion of each link in a chain based on its own capacity
+            self.dfLink['Congestion'] = ifn.hadamardDivision(self.dfLink['EstFlow'].values,
+                                                             self.dfLink['Capacity'].values.astype(float))
         self.computeLinkPerformance()
+        if self.equilibrium is not None:
+            self.runEquilibrium(theta=self.equilibrium.get("theta", 60),
+                                max_iteration=self.equilibrium.get("max-iteration", 100),
+                                tolerance=self.equilibrium.get("tolerance", 1e-4))
+        if self.sensitivity is not None:
+            # gradient of the outputs with respect to the link capacities as columns of dfLink
+            self.capacitySensitivity(outputs=self.sensitivity.get("outputs", ("max-congestion", "total-delay")),
+                                     links=self.sensitivity.get("links", ()))
 
         # save output mLink
         dfLink_file_name = os.path.join(self.folder_path, self.id + ".csv")
@@ -230,7 +356,7 @@ class Scenario():
         report = (str(self.__str__()) + \
                   "\n\n" + str(self.networks['network-0']) + \
                   "\n\nNetwork performance:\n" + \
-                  "\tTotal Flow = " + str(round(kappa, 2)) + " pcu/hour" + "\n" + \
+                  "\tTotal Flow = " + str(round(np.sum(self.dfLink['EstFlow']), 2)) + " pcu/hour" + "\n" + \
                   "\tMax Congestion = " + str(round(maxCongestion, 4)) + "\n" + \
                   "\tAvg Link Speed =" + str(round(avgSpeed, 4)) + " km/hour\n" + \
                   "\tAvg Link Travel Time = " + str(round(60 * avgTravelTime / avgDist, 4)) + " min/km\n" + \
@@ -245,88 +371,1004 @@ class Scenario():
         with open(report_file_name, 'w') as fh:
             fh.write(report)  # i
 
+        if self.uncertainty is not None:
+            # Monte Carlo capacity uncertainty
+            u = self.uncertainty
+            dfUncertainty = self.monteCarloCapacity(draws=u.get("draws", 1000),
+                                                    distribution=u.get("distribution", "lognormal"),
+                                                    cv=u.get("cv", 0.2),
+                                                    road_type_cv=u.get("road-type"),
+                                                    cv_field=u.get("cv-field"),
+                                                    quantiles=u.get("quantiles", (0.05, 0.5, 0.95)),
+                                                    seed=u.get("seed", 0),
+                                                    workers=u.get("workers", 1))
+            uncertainty_file_name = os.path.join(self.folder_path, self.id + "_uncertainty.csv")
+            dfUncertainty.to_csv(uncertainty_file_name, index=False, quoting=csv.QUOTE_NONNUMERIC)
+
+        if self.skim is not None:
+            # zone to zone travel time, cached as <scenario id>_skim_<hash>.npy
+            self.travelTimeSkim(zones=self.skim.get("zones"), field=self.skim.get("field", "TravelTime"),
+                                workers=self.skim.get("workers", 1))
+
+        if self.trajectory is not None:
+            # synthetic vehicle trajectories, saved as <scenario id>_trajectory.npy
+            self.sampleTrajectories(self.trajectory.get("walks", 10000), self.trajectory.get("steps", 100),
+                                    seed=self.trajectory.get("seed", 0), workers=self.trajectory.get("workers", 1))
+
+        if self.origins is not None:
+            # origin of the flow on each link and origin-destination flow
+            self.originAttribution(self.origins)
+
+        if self.periods is not None:
+            # time of day: one file of period x link arrays
+            results = self.runPeriods(self.periods)
+            periods_file_name = os.path.join(self.folder_path, self.id + "_periods.npz")
+            np.savez(periods_file_name, **results)
+
         plt = self.networks['network-0'].display_network('Congestion')  # display network congestion
         plt.show()
 
+    def runNetworks(self):
+        """
+        solve a scenario of several networks (e.g. car and motorcycle layers,
+        or districts linked by a shared cloud node) by one sparse system:
+            "network-coupling": "block" (default)
+                each network is an independent Markov chain, solved together
+                as one block diagonal system, and receives the share
+                network_weight / sum of network_weight of the total flow
+            "network-coupling": "coupled"
+                the networks are joined by their common NodeID into one Markov chain,
+                network_weight multiplies the capacity of its links in the link choice
+        the total flow is calibrated by "total-flow" or "max-congestion" over all networks.
+        add EstFlow, Congestion, Speed, TravelTime, Delay to dfLink of each network
+        and save the link table of all networks (<scenario id>.csv, with column Network
+        and CombinedFlow = total flow of all networks between the same two nodes)
+        and the performance of each network and in total (<scenario id>.net)
+        (the analyses of analysisKeys are not available, runScenario raises ValueError)
+        return pandas DataFrame of the network performance
+        """
+        networks = list(self.networks.values())
+        weights = np.array([float(net.network_weight) for net in networks])
+        isCoupled = self.network_coupling == "coupled"
+
+        # node index of each link: shared node ids (coupled) or an offset block per network
+        nodeIds = [np.union1d(net.dfLink.Node1, net.dfLink.Node2) for net in networks]
+        if isCoupled:
+            allNodeIds = np.unique(np.concatenate(nodeIds))
+            offsets = [0] * len(networks)
+        else:
+            allNodeIds = None
+            offsets = np.concatenate([[0], np.cumsum([len(ids) for ids in nodeIds])])
+        rows, cols, capacities, linkWeights = [], [], [], []
+        for i, net in enumerate(networks):
+            ids = allNodeIds if isCoupled else nodeIds[i]
+            rows.append(offsets[i] + np.searchsorted(ids, net.dfLink.Node1.values))
+            cols.append(offsets[i] + np.searchsorted(ids, net.dfLink.Node2.values))
+            capacities.append(net.dfLink['Capacity'].values.astype(float))
+            linkWeights.append(capacities[-1] * (weights[i] if isCoupled else 1))
+        linkNetwork = np.concatenate([np.full(len(r), i) for i, r in enumerate(rows)])
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        capacity, linkWeight = np.concatenate(capacities), np.concatenate(linkWeights)
+
+        if isCoupled:
+            n = len(allNodeIds)
+            s = ifn.linkStochastic(rows, linkWeight, n)
+            X = ifn.linkMarkovMatrix(ifn.linkMarkovPattern(rows, cols, n), s)
+            y = np.zeros(n)
+            y[-1] = 1
+        else:
+            # one block per network, each with its own sum(pi)=1
+            n = offsets[-1]
+            s = ifn.linkStochastic(rows, linkWeight, n)
+            blocks = []
+            for i in range(len(networks)):
+                isBlock = linkNetwork == i
+                blocks.append(ifn.linkMarkovMatrix(
+                    ifn.linkMarkovPattern(rows[isBlock] - offsets[i], cols[isBlock] - offsets[i], len(nodeIds[i])),
+                    s[isBlock]))
+            X = sparse.block_diag(blocks, format='csc')
+            y = np.zeros(n)
+            y[offsets[1:] - 1] = 1
+        try:
+            pi = splinalg.spsolve(X, y)
+        except RuntimeError:
+            pi = np.full(n, np.nan)
+        if np.any(np.isnan(pi)):
+            print("Some network is not strongly connected. Clean the network data either by finding the largest "
+                  "strongly connected component or add a cloud node and dummy links.")
+            return None
+        basisFlow = pi[rows] * s
+        if not isCoupled:
+            basisFlow = basisFlow * (weights / np.sum(weights))[linkNetwork]
+        basisCongestion = ifn.hadamardDivision(basisFlow, capacity)
+
+        kappa = 1
+        if self.calibration_basis == "total-flow":
+            kappa = self.total_flow / np.sum(basisFlow)
+        elif self.calibration_basis == "max-congestion":
+            kappa = float(self.max_allowable_congestion) / np.max(basisCongestion)
+        else:
+            print("calibration basis", self.calibration_basis, "is not available for several networks, kappa = 1")
+        self.kappa = kappa * np.sum(basisFlow)  # total flow of all networks
+
+        # link performance of each network
+        performances = []
+        dfLinks = []
+        for i, net in enumerate(networks):
+            isNet = linkNetwork == i
+            dfLink = net.dfLink
+            dfLink['BasisFlow'] = basisFlow[isNet]
+            dfLink['EstFlow'] = kappa * basisFlow[isNet]
+            dfLink['Congestion'] = kappa * basisCongestion[isNet]
+            travelTime = self.linkTravelTime(dfLink['Congestion'].values, dfLink)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                minTravelTime = dfLink['Distance'].values / dfLink['MaxSpeed'].values
+                speed = np.where(travelTime > 0, dfLink['Distance'].values / travelTime, 0)
+            isCloud = (dfLink.Node1.astype(str) == str(net.cloud_node_id)).values | \
+                      (dfLink.Node2.astype(str) == str(net.cloud_node_id)).values
+            dfLink['Speed'] = np.where(isCloud, np.nan, speed)
+            dfLink['TravelTime'] = np.where(isCloud, np.nan, travelTime)
+            dfLink['Delay'] = np.where(isCloud, np.nan, travelTime - minTravelTime)
+            performances.append(self.networkPerformance(net.id, weights[i], dfLink))
+            dfLinks.append(dfLink.reset_index().assign(Network=net.id))
+
+        dfAll = pd.concat(dfLinks, ignore_index=True)
+        dfAll['CombinedFlow'] = dfAll.groupby(['Node1', 'Node2'])['EstFlow'].transform('sum')
+        performances.append(self.networkPerformance("total", np.sum(weights), dfAll))
+        dfPerformance = pd.DataFrame(performances)
+
+        dfLink_file_name = os.path.join(self.folder_path, self.id + ".csv")
+        dfAll.to_csv(dfLink_file_name, index=False, quoting=csv.QUOTE_NONNUMERIC)
+        report = (str(self.__str__()) + "\n\n" +
+                  "\n\n".join(str(net) for net in networks) +
+                  "\n\nnetwork coupling = " + str(self.network_coupling) +
+                  "\n\nNetwork performance:\n" + dfPerformance.to_string(index=False) + "\n")
+        print(report)
+        report_file_name = os.path.join(self.folder_path, self.id + ".net")
+        with open(report_file_name, 'w') as fh:
+            fh.write(report)
+        return dfPerformance
+
+    def runClasses(self):
+        """
+        solve the scenario for several vehicle classes in one sparse system.
+        Each class in "classes" of the model is a dictionary of
+            "pcu": passenger car unit of a vehicle (default 1)
+            "share": share of the vehicles of the total flow (default equal shares)
+            "road-type": list of permitted RoadType, or
+            "exclude-road-type": list of forbidden RoadType
+            "link-field": boolean column of dfLink of the permitted links
+        each class uses the capacity of its permitted links within the largest
+        strongly connected part of them; the Markov chains of all classes
+        are solved together as one block diagonal system.
+        The total flow (pcu) is calibrated by "total-flow" or "max-congestion"
+        and the congestion is based on the total pcu flow of all classes.
+        add EstFlow (pcu), Congestion and link performance to dfLink,
+        save dfLink (<scenario id>.csv), the flow of each class in vehicles
+        as (class x link) float32 array (<scenario id>_classes.npz)
+        and the network performance (<scenario id>.net)
+        (the analyses of analysisKeys are not available, runScenario raises ValueError)
+        return dictionary of Class, LinkID, ClassFlow, PCU, Share
+        """
+        names = list(self.classes.keys())
+        numClasses = len(names)
+        pcu = np.array([float(self.classes[c].get("pcu", 1)) for c in names])
+        share = np.array([float(self.classes[c].get("share", 1 / numClasses)) for c in names])
+        share = share / np.sum(share)
+
+        dfLink = self.dfLink
+        m = len(dfLink)
+        nodeIds = np.union1d(dfLink.Node1, dfLink.Node2)
+        n = len(nodeIds)
+        rows = np.searchsorted(nodeIds, dfLink.Node1.values)
+        cols = np.searchsorted(nodeIds, dfLink.Node2.values)
+        capacity = dfLink['Capacity'].values.astype(float)
+
+        blocks = []
+        blockLinks = []
+        blockStochastic = []
+        blockNodes = []
+        for c in names:
+            spec = self.classes[c]
+            permitted = capacity > 0
+            if "road-type" in spec and "RoadType" in dfLink:
+                permitted &= dfLink["RoadType"].isin(spec["road-type"]).values
+            if "exclude-road-type" in spec and "RoadType" in dfLink:
+                permitted &= ~dfLink["RoadType"].isin(spec["exclude-road-type"]).values
+            if "link-field" in spec:
+                permitted &= dfLink[spec["link-field"]].astype(bool).values
+            # largest strongly connected part of the permitted links
+            A = sparse.csr_matrix((np.ones(np.sum(permitted)), (rows[permitted], cols[permitted])), shape=(n, n))
+            _, component = csgraph.connected_components(A, directed=True, connection='strong')
+            isNode = np.zeros(n, dtype=bool)
+            isNode[np.diff(A.indptr) > 0] = True
+            largest = np.argmax(np.bincount(component[isNode], minlength=n))
+            links = np.flatnonzero(permitted & (component[rows] == largest) & (component[cols] == largest))
+            if len(links) < np.sum(permitted):
+                print("class", c, "uses", len(links), "of", np.sum(permitted),
+                      "permitted links in its largest strongly connected part")
+            classNodes = np.union1d(rows[links], cols[links])
+            r = np.searchsorted(classNodes, rows[links])
+            k = np.searchsorted(classNodes, cols[links])
+            s = ifn.linkStochastic(r, capacity[links], len(classNodes))
+            blocks.append(ifn.linkMarkovMatrix(ifn.linkMarkovPattern(r, k, len(classNodes)), s))
+            blockLinks.append(links)
+            blockStochastic.append(s)
+            blockNodes.append((r, len(classNodes)))
+
+        # one block diagonal system, each block with its own sum(pi)=1
+        X = sparse.block_diag(blocks, format='csc')
+        sizes = np.array([size for _, size in blockNodes])
+        offsets = np.concatenate([[0], np.cumsum(sizes)])
+        y = np.zeros(offsets[-1])
+        y[offsets[1:] - 1] = 1
+        pi = splinalg.spsolve(X, y)
+
+        # basis vehicle flow of each class (sum = share) and total pcu flow
+        classFlow = np.zeros((numClasses, m))
+        for i in range(numClasses):
+            r, _ = blockNodes[i]
+            classFlow[i, blockLinks[i]] = share[i] * pi[offsets[i] + r] * blockStochastic[i]
+        pcuFlow = pcu.dot(classFlow)
+        pcuCongestion = ifn.hadamardDivision(pcuFlow, capacity)
+
+        kappa = 1
+        if self.calibration_basis == "total-flow":
+            kappa = self.total_flow / np.sum(pcuFlow)
+        elif self.calibration_basis == "max-congestion":
+            kappa = float(self.max_allowable_congestion) / np.max(pcuCongestion)
+        else:
+            print("calibration basis", self.calibration_basis, "is not available for vehicle classes, kappa = 1")
+        self.kappa = kappa * np.sum(pcuFlow)  # total pcu flow
+
+        dfLink['BasisFlow'] = pcuFlow / np.sum(pcuFlow)  # sums to one, EstFlow = self.kappa * BasisFlow
+        dfLink['EstFlow'] = kappa * pcuFlow
+        dfLink['Congestion'] = kappa * pcuCongestion
+        self.computeLinkPerformance()
+        dfLink_file_name = os.path.join(self.folder_path, self.id + ".csv")
+        dfLink.to_csv(dfLink_file_name, quoting=csv.QUOTE_NONNUMERIC)
+
+        results = {'Class': np.array(names), 'LinkID': dfLink.index.values,
+                   'ClassFlow': (kappa * classFlow).astype(np.float32), 'PCU': pcu, 'Share': share}
+        classes_file_name = os.path.join(self.folder_path, self.id + "_classes.npz")
+        np.savez(classes_file_name, **results)
+
+        performances = [self.networkPerformance("pcu", 1, dfLink)]
+        for i, c in enumerate(names):
+            performances[0]['Vehicles ' + c] = kappa * np.sum(classFlow[i])
+        report = (str(self.__str__()) + "\n\n" + str(self.networks['network-0']) +
+                  "\n\nclasses = " + str(self.classes) +
+                  "\n\nNetwork performance:\n" + pd.DataFrame(performances).T.to_string(header=False) + "\n")
+        print(report)
+        report_file_name = os.path.join(self.folder_path, self.id + ".net")
+        with open(report_file_name, 'w') as fh:
+            fh.write(report)
+        return results
+
+    def networkPerformance(self, network, weight, dfLink):
+        """
+        return dictionary of network performance of the links in dfLink
+        (same measures as the scenario report)
+        """
+        avgDist = np.nanmean(dfLink['Distance'])
+        return {'Network': network,
+                'Weight': weight,
+                'TotalFlow': np.sum(dfLink['EstFlow']),
+                'MaxCongestion': np.max(dfLink['Congestion']),
+                'AvgSpeed': np.nanmean(dfLink['Speed']),
+                'AvgTravelTime': 60 * np.nanmean(dfLink['TravelTime']) / avgDist,
+                'AvgDelay': 3600 * np.nanmean(dfLink['Delay']) / avgDist}
+
     def addField2dfLink(self, F, field):
         """
         update self.dfLink with additional column about matrix F.
         Matrix F size must be n by n, where n is number of nodes
+        of the solved network (contracted network if the chains are contracted)
         """
-        if not self.nodeIds:
-            # get unique node IDs from second and third fields of mLink
-            self.nodeIds = list(np.union1d(self.dfLink.Node1, self.dfLink.Node2))
+        net = self.networks['network-0']
+        r, c = self.linkNodeIndex()
+        arrF = np.asarray(F[r, c]).ravel()
+        self.dfLink[field] = net.expand_chains(arrF)
 
-        mR, mC = self.dfLink.shape
-        arrF = []
-        for index, row in self.dfLink.iterrows():
-            r = self.nodeIds.index(row.Node1)
-            c = self.nodeIds.index(row.Node2)
-            v = F[r - 1, c - 1]
-            arrF.append(v)
-        self.dfLink[field] = arrF
+    def runCapacityVariants(self, capacities, kappa=None, chunkSize=64):
+        """
+        solve the ideal flow of k capacity variants of the scenario network at once
+        capacities = (k x m) array, each row is a Capacity column of dfLink (m links)
+        kappa = total flow of each variant, scalar or vector of k values
+                (default: total flow of the calibrated scenario)
+        return (k x m) arrays of EstFlow and Congestion in the link order of dfLink
+        """
+        if kappa is None:
+            kappa = self.kappa if self.kappa is not None else 1
+        nodeIds = np.union1d(self.dfLink.Node1, self.dfLink.Node2)
+        rows = np.searchsorted(nodeIds, self.dfLink.Node1.values)
+        cols = np.searchsorted(nodeIds, self.dfLink.Node2.values)
+        return ifn.batchIdealFlow(rows, cols, capacities, kappa, numNodes=len(nodeIds), chunkSize=chunkSize)
+
+    def sweep(self, alpha=None, beta=None, max_allowable_congestion=None, total_flow=None, blockSize=1000000):
+        """
+        evaluate network performance over all combinations of the parameter grids
+        without solving the network again: the link flow is kappa * BasisFlow
+        and the link performance is computed elementwise by broadcasting.
+        alpha, beta = BPR parameters (default from travel-cost-parameters or 15, 4)
+        max_allowable_congestion, total_flow = calibration values, each value gives
+                a kappa (default: the calibrated kappa of the scenario)
+        each parameter is a scalar or a list of values.
+        The scenario must have been run (BasisFlow in dfLink).
+        return pandas DataFrame with one row per grid point:
+            Alpha, Beta, CalibrationBasis, CalibrationValue, TotalFlow (sum of the link flow),
+            MaxCongestion, AvgSpeed (km/hour), AvgTravelTime (min/km), AvgDelay (seconds/km)
+        """
+        if self.dfLink is None or "BasisFlow" not in self.dfLink:
+            print("Run the scenario before the parameter sweep.")
+            return None
+        parameters = self.travel_cost_model_parameters or {}
+        alphas = np.ravel(np.asarray(parameters.get('alpha', 15) if alpha is None else alpha, dtype=float))
+        betas = np.ravel(np.asarray(parameters.get('beta', 4) if beta is None else beta, dtype=float))
+
+        basisFlow = self.dfLink['BasisFlow'].values.astype(float)
+        capacity = self.dfLink['Capacity'].values.astype(float)
+        basisCongestion = ifn.hadamardDivision(basisFlow, capacity)
+        maxBasisCongestion = np.max(basisCongestion)
+
+        # calibration points
+        calibrations = []
+        for value in np.ravel([] if max_allowable_congestion is None else max_allowable_congestion):
+            calibrations.append(("max-congestion", float(value), float(value) / maxBasisCongestion))
+        for value in np.ravel([] if total_flow is None else total_flow):
+            calibrations.append(("total-flow", float(value), float(value) / np.sum(basisFlow)))
+        if not calibrations:
+            value = self.max_allowable_congestion if self.calibration_basis == "max-congestion" else self.total_flow
+            calibrations.append((self.calibration_basis, value, self.kappa))
+        kappas = np.array([kappa for _, _, kappa in calibrations], dtype=float)
+
+        # links to cloud node have no performance
+        cloudNode = self.networks['network-0'].cloud_node_id
+        isCloud = np.zeros(len(self.dfLink), dtype=bool)
+        if cloudNode is not None:
+            isCloud = (self.dfLink.Node1.astype(str) == str(cloudNode)).values | \
+                      (self.dfLink.Node2.astype(str) == str(cloudNode)).values
+        avgDist = np.nanmean(self.dfLink['Distance'])
+        dist = self.dfLink['Distance'].values[~isCloud].astype(float)
+        maxSpeed = self.dfLink['MaxSpeed'].values[~isCloud].astype(float)
+        g0 = basisCongestion[~isCloud]
+        numLinks = len(dist)
+
+        A, B, P = len(alphas), len(betas), len(kappas)
+        avgSpeed = np.empty((A, B, P))
+        avgTravelTime = np.empty((A, B, P))
+        avgDelay = np.empty((A, B, P))
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            minTravelTime = dist / maxSpeed  # t0 in hour
+            if self.travel_cost_model == 'Greenshield':
+                # no model parameter: same performance for every alpha and beta
+                g = kappas[:, None] * g0[None, :]
+                speed = np.where(g <= 1, maxSpeed / 2 * (1 + np.sqrt(np.abs(1 - g))), 0)
+                travelTime = np.where(speed > 0, dist / speed, np.inf)
+                delay = np.where(g <= 1, travelTime - np.where(maxSpeed > 0, minTravelTime, np.inf), np.inf)
+                avgSpeed[:] = np.nanmean(speed, axis=1)
+                avgTravelTime[:] = np.nanmean(np.where(g <= 1, travelTime, np.inf), axis=1)
+                avgDelay[:] = np.nanmean(delay, axis=1)
+            else:
+                # BPR: t = t0 * (1 + alpha * (kappa * g0)^beta) = t0 * (1 + c * g0^beta)
+                for b, beta in enumerate(betas):
+                    h = g0 ** beta
+                    c = (alphas[:, None] * kappas[None, :] ** beta).ravel()
+                    avgDelay[:, b, :] = (c * np.nanmean(minTravelTime * h)).reshape(A, P)
+                    avgTravelTime[:, b, :] = np.nanmean(minTravelTime) + avgDelay[:, b, :]
+                    speed = np.empty(len(c))
+                    step = max(1, blockSize // max(numLinks, 1))
+                    for start in range(0, len(c), step):
+                        travelTime = minTravelTime[None, :] * (1 + c[start:start + step, None] * h[None, :])
+                        speed[start:start + step] = np.nanmean(
+                            np.where(travelTime > 0, dist[None, :] / travelTime, 0), axis=1)
+                    avgSpeed[:, b, :] = speed.reshape(A, P)
+
+        a, b, p = [index.ravel() for index in np.meshgrid(np.arange(A), np.arange(B), np.arange(P), indexing='ij')]
+        return pd.DataFrame({
+            'Alpha': alphas[a],
+            'Beta': betas[b],
+            'CalibrationBasis': [calibrations[i][0] for i in p],
+            'CalibrationValue': [calibrations[i][1] for i in p],
+            'TotalFlow': kappas[p] * np.sum(basisFlow),  # link flow is kappa * BasisFlow
+            'MaxCongestion': kappas[p] * maxBasisCongestion,
+            'AvgSpeed': avgSpeed.ravel(),
+            'AvgTravelTime': 60 * avgTravelTime.ravel() / avgDist,
+            'AvgDelay': 3600 * avgDelay.ravel() / avgDist,
+        })
+
+    def monteCarloCapacity(self, draws=1000, distribution="lognormal", cv=0.2, road_type_cv=None, cv_field=None,
+                           quantiles=(0.05, 0.5, 0.95), seed=0, workers=1, chunkSize=64, bins=200):
+        """
+        Monte Carlo simulation of link congestion under uncertain capacity.
+        Each draw multiplies the Capacity of every link by a random factor of mean 1
+        and coefficient of variation cv ("lognormal", "normal" or "uniform"),
+        cv per road type {RoadType: cv} (road_type_cv) or per link (column cv_field of dfLink)
+        overrides the default cv. The ideal flow of each draw is solved at the
+        calibrated total flow by batches of chunkSize draws, in parallel by workers.
+        Every chunk has its own seed spawned from seed, thus the result
+        does not depend on the number of workers.
+
+        The statistics are accumulated without storing the draws: sum and
+        sum of squares for the mean and standard deviation, count of congestion>1,
+        and a histogram of log(congestion) per link for the quantiles, whose bins
+        span the range of the first chunk widened by half of its span on both sides.
+        return pandas DataFrame of LinkID, MeanCongestion, StdCongestion,
+            Q<quantile> for each quantile and ProbCongested = P(congestion>1)
+        """
+        if self.dfLink is None or "Congestion" not in self.dfLink:
+            print("Run the scenario before the Monte Carlo simulation.")
+            return None
+        capacity = self.dfLink['Capacity'].values.astype(float)
+        m = len(capacity)
+        linkCV = np.full(m, float(cv))
+        if road_type_cv and "RoadType" in self.dfLink:
+            for roadType, value in road_type_cv.items():
+                linkCV[(self.dfLink["RoadType"] == roadType).values] = float(value)
+        if cv_field is not None and cv_field in self.dfLink:
+            linkCV = self.dfLink[cv_field].fillna(pd.Series(linkCV, index=self.dfLink.index)).values.astype(float)
+
+        kappa = self.kappa if self.kappa is not None else 1
+
+        def factors(rng, k):
+            if distribution == "normal":
+                return np.maximum(1 + linkCV * rng.standard_normal((k, m)), 0.01)
+            elif distribution == "uniform":
+                halfWidth = linkCV * np.sqrt(3)
+                return 1 + halfWidth * rng.uniform(-1, 1, (k, m))
+            sigma = np.sqrt(np.log(1 + linkCV ** 2))
+            return np.exp(sigma * rng.standard_normal((k, m)) - sigma ** 2 / 2)
+
+        def congestion(task):
+            start, k, seedSequence = task
+            rng = np.random.default_rng(seedSequence)
+            _, G = self.runCapacityVariants(capacity * factors(rng, k), kappa, chunkSize=k)
+            return G[~np.isnan(G).any(axis=1)]
+
+        def statistics(G):
+            logG = np.log(np.maximum(G, tiny))
+            binIndex = np.clip(np.floor((logG - lower) / width).astype(np.int64), 0, bins - 1)
+            histogram = np.zeros((m, bins), dtype=np.int64)
+            np.add.at(histogram, (np.broadcast_to(np.arange(m), G.shape), binIndex), 1)
+            return len(G), np.sum(G, axis=0), np.sum(G ** 2, axis=0), np.sum(G > 1, axis=0), histogram
+
+        def simulate(task):
+            return statistics(congestion(task))
+
+        starts = list(range(0, draws, chunkSize))
+        seeds = np.random.SeedSequence(seed).spawn(len(starts))
+        tasks = [(start, min(chunkSize, draws - start), seeds[i]) for i, start in enumerate(starts)]
+
+        # the first chunk sets the log range of the histogram of each link, widened by half of its span
+        G = congestion(tasks[0])
+        tiny = 1e-12 * max(np.max(G), 1e-300)
+        logMin = np.log(np.maximum(np.min(G, axis=0), tiny))
+        logMax = np.log(np.maximum(np.max(G, axis=0), tiny))
+        span = np.maximum(logMax - logMin, 0.1)
+        lower = logMin - span / 2
+        width = 2 * span / bins
+        results = [statistics(G)]
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results.extend(executor.map(simulate, tasks[1:]))
+        else:
+            results.extend(simulate(task) for task in tasks[1:])
+
+        n = sum(result[0] for result in results)
+        total = sum(result[1] for result in results)
+        totalSquare = sum(result[2] for result in results)
+        congested = sum(result[3] for result in results)
+        histogram = sum(result[4] for result in results)
+
+        mean = total / n
+        std = np.sqrt(np.maximum(totalSquare / n - mean ** 2, 0) * n / max(n - 1, 1))
+        dfUncertainty = pd.DataFrame({'LinkID': self.dfLink.index.values,
+                                      'MeanCongestion': mean,
+                                      'StdCongestion': std})
+        cumulative = np.cumsum(histogram, axis=1)
+        for q in quantiles:
+            # interpolate within the bin of the quantile
+            target = q * n
+            j = np.argmax(cumulative >= target, axis=1)
+            below = np.where(j > 0, cumulative[np.arange(m), j - 1], 0)
+            inBin = np.maximum(histogram[np.arange(m), j], 1)
+            fraction = np.clip((target - below) / inBin, 0, 1)
+            dfUncertainty['Q' + str(q)] = np.exp(lower + (j + fraction) * width)
+        dfUncertainty['ProbCongested'] = congested / n
+        return dfUncertainty
+
+    def travelTimeSkim(self, zones=None, field='TravelTime', chunkSize=256, workers=1, isCache=True):
+        """
+        return zones and the shortest travel time (float32, hour) from each zone to each zone
+        over the links weighted by field of dfLink (default congested TravelTime;
+        links to the cloud node and links with infinite travel time are not used,
+        the fastest of parallel links is used).
+        zones = list of NodeID (default all nodes), an unknown NodeID raises ValueError;
+                unreachable zones get inf.
+        Dijkstra from the zones runs in chunks of chunkSize sources (in parallel by workers)
+        and is written into <scenario id>_skim_<hash>.npy, a memory mapped array
+        (written under a temporary name and renamed when complete).
+        The hash is based on the link travel time, network and zones, thus the skim
+        is reproducible and, if isCache, loaded from the file when it exists.
+        """
+        nodeIds = np.union1d(self.dfLink.Node1, self.dfLink.Node2)
+        n = len(nodeIds)
+        zones = nodeIds if zones is None else np.asarray(zones)
+        isUnknown = ~np.isin(zones, nodeIds)
+        if np.any(isUnknown):
+            raise ValueError("unknown zone NodeID: " + ", ".join(map(str, zones[isUnknown])))
+        rows = np.searchsorted(nodeIds, self.dfLink.Node1.values)
+        cols = np.searchsorted(nodeIds, self.dfLink.Node2.values)
+        travelTime = self.dfLink[field].values.astype(np.float64)
+        isUsed = np.isfinite(travelTime)
+        cloudNode = self.networks['network-0'].cloud_node_id
+        if cloudNode:
+            isUsed &= (self.dfLink.Node1.astype(str) != str(cloudNode)).values & \
+                      (self.dfLink.Node2.astype(str) != str(cloudNode)).values
+        rows, cols, travelTime = rows[isUsed], cols[isUsed], travelTime[isUsed]
+
+        digest = hashlib.sha1()
+        for array in (nodeIds, rows, cols, travelTime, zones):
+            digest.update(np.ascontiguousarray(array).tobytes())
+        skim_file_name = os.path.join(self.folder_path, self.id + "_skim_" + digest.hexdigest()[:16] + ".npy")
+        if isCache and os.path.exists(skim_file_name):
+            skim = np.load(skim_file_name, mmap_mode='r')
+            if skim.shape == (len(zones), len(zones)):
+                return zones, skim
+
+        # fastest of parallel links
+        key = rows.astype(np.int64) * n + cols
+        order = np.lexsort((travelTime, key))
+        key, travelTime = key[order], travelTime[order]
+        isFirst = np.concatenate([[True], key[1:] != key[:-1]])
+        graph = sparse.csr_matrix((travelTime[isFirst], (key[isFirst] // n, key[isFirst] % n)), shape=(n, n))
+
+        zoneIndex = np.searchsorted(nodeIds, zones)
+        # an interrupted run leaves no incomplete skim under the cache name
+        temp_file_name = skim_file_name[:-len(".npy")] + "_" + str(os.getpid()) + ".tmp"
+        skim = np.lib.format.open_memmap(temp_file_name, mode='w+', dtype=np.float32, shape=(len(zones), len(zones)))
+
+        def solve(start):
+            sources = zoneIndex[start:start + chunkSize]
+            distance = csgraph.dijkstra(graph, directed=True, indices=sources)
+            skim[start:start + len(sources)] = distance[:, zoneIndex]
+
+        starts = range(0, len(zones), chunkSize)
+        try:
+            if workers > 1:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    list(executor.map(solve, starts))
+            else:
+                for start in starts:
+                    solve(start)
+            skim.flush()
+        except BaseException:
+            del skim
+            os.remove(temp_file_name)
+            raise
+        del skim  # close the memory map before renaming
+        os.replace(temp_file_name, skim_file_name)
+        return zones, np.load(skim_file_name, mmap_mode='r')
+
+    def sampleTrajectories(self, numWalks, numSteps, seed=0, workers=1, batchSize=10000):
+        """
+        sample numWalks random walks of numSteps links on the scenario network
+        (see ifn.sampleTrajectories), starting from nodes drawn from the Markov vector,
+        and stream them into <scenario id>_trajectory.npy as
+        (numWalks x numSteps+1) integer array of NodeID
+        return the memory mapped array
+        """
+        nodeIds = np.union1d(self.dfLink.Node1, self.dfLink.Node2)
+        n = len(nodeIds)
+        rows = np.searchsorted(nodeIds, self.dfLink.Node1.values)
+        cols = np.searchsorted(nodeIds, self.dfLink.Node2.values)
+        s = ifn.linkStochastic(rows, self.dfLink['Capacity'].values.astype(float), n)
+        S = sparse.csr_matrix((s, (rows, cols)), shape=(n, n))
+        trajectory_file_name = os.path.join(self.folder_path, self.id + "_trajectory.npy")
+        return ifn.sampleTrajectories(S, numWalks, numSteps, seed=seed, batchSize=batchSize, workers=workers,
+                                      fileName=trajectory_file_name, labels=nodeIds)
+
+    def trajectory2ifn(self, trajectories, chunkSize=100000, workers=1):
+        """
+        build the observed flow from trajectories of NodeID, e.g. GPS or ANPR
+        trajectories = .npy file name (read by memory map), 2D array
+                       (trajectory x position, padded by any value that is not a NodeID),
+                       or iterable of chunks (2D arrays or lists of NodeID sequences)
+        2D trajectories are counted in chunks of chunkSize trajectories (in parallel by workers)
+        add ObservedFlow (number of transitions, parallel links share by capacity) to dfLink
+        return observed flow matrix and its stochastic matrix (sparse, node order of NodeID)
+        """
+        if isinstance(trajectories, str):
+            trajectories = np.load(trajectories, mmap_mode='r')
+        if isinstance(trajectories, np.ndarray):
+            array = trajectories
+            trajectories = (array[start:start + chunkSize] for start in range(0, len(array), chunkSize))
+        nodeIds = np.union1d(self.dfLink.Node1, self.dfLink.Node2)
+        n = len(nodeIds)
+        rows = np.searchsorted(nodeIds, self.dfLink.Node1.values)
+        cols = np.searchsorted(nodeIds, self.dfLink.Node2.values)
+        counts, unmatched = ifn.trajectoryCounts(trajectories, rows, cols, numNodes=n, labels=nodeIds,
+                                                 weights=self.dfLink['Capacity'].values.astype(float),
+                                                 workers=workers)
+        if unmatched > 0:
+            print(unmatched, "transitions of the trajectories are not on a link of the network")
+        self.dfLink['ObservedFlow'] = counts
+        F = sparse.csr_matrix((counts, (rows, cols)), shape=(n, n))
+        return F, ifn.capacity2stochastic(F)
+
+    def originAttribution(self, origins, chunkSize=64, workers=1, kappa=None):
+        """
+        decompose the estimated flow of each link by its origin, the last of
+        the origin nodes that the flow passed (see ifn.originFlow), without
+        any dense n x n matrix. The origins are solved in chunks and the
+        link flows are streamed to <scenario id>_origin.csv
+        (Origin, LinkID, Flow of the links with flow from the origin).
+        origins = list of NodeID
+        kappa = total flow (default: the calibrated kappa of the scenario)
+        save and return pandas DataFrame of the origin-destination flow
+        between the origins (<scenario id>_od.csv)
+        """
+        if kappa is None:
+            kappa = self.kappa if self.kappa is not None else 1
+        nodeIds = np.union1d(self.dfLink.Node1, self.dfLink.Node2)
+        n = len(nodeIds)
+        rows = np.searchsorted(nodeIds, self.dfLink.Node1.values)
+        cols = np.searchsorted(nodeIds, self.dfLink.Node2.values)
+        s = ifn.linkStochastic(rows, self.dfLink['Capacity'].values.astype(float), n)
+        S = sparse.csr_matrix((s, (rows, cols)), shape=(n, n))
+        S.sum_duplicates()
+        pi = ifn.sparseMarkov(S, kappa)
+        # position of each link in S; parallel links share the flow by their stochastic value
+        S.sort_indices()
+        entryKey = np.repeat(np.arange(n, dtype=np.int64), np.diff(S.indptr)) * n + S.indices
+        position = np.searchsorted(entryKey, rows.astype(np.int64) * n + cols)
+        linkShare = ifn.hadamardDivision(s, S.data[position])
+
+        origins = np.asarray(origins)
+        originIndex = np.searchsorted(nodeIds, origins)
+        origin_file_name = os.path.join(self.folder_path, self.id + "_origin.csv")
+        od = []
+        header = True
+        linkIds = self.dfLink.index.values
+        for chunk, flow, toOrigin in ifn.originFlow(S, pi, originIndex, chunkSize=chunkSize, workers=workers):
+            linkFlow = flow[:, position] * linkShare
+            o, l = np.nonzero(linkFlow > 1e-12 * kappa)
+            pd.DataFrame({'Origin': nodeIds[chunk][o], 'LinkID': linkIds[l], 'Flow': linkFlow[o, l]}).to_csv(
+                origin_file_name, mode='w' if header else 'a', header=header, index=False)
+            header = False
+            od.append(toOrigin)
+        dfOD = pd.DataFrame(np.vstack(od), index=pd.Index(origins, name='Origin'), columns=origins)
+        dfOD.to_csv(os.path.join(self.folder_path, self.id + "_od.csv"))
+        return dfOD
+
+    def runPeriods(self, periods):
+        """
+        solve the scenario network for a sequence of periods (e.g. hours of the day)
+        each period is a dictionary of
+            "name": period name
+            "total-flow" or "max-allowable-congestion": calibration of the period
+                (default: the calibrated kappa of the scenario)
+            "capacity": {LinkID: capacity} change of link capacity in the period
+                (e.g. tidal lanes, peak-hour bans), relative to the scenario network;
+                an unknown LinkID raises ValueError
+        The periods share the sparse Markov system pattern. A period with the same
+        capacity as the previous one only scales its flow, otherwise it is solved by
+        iterative refinement from the Markov vector of the previous period with the
+        LU factorization of an earlier period.
+        return dictionary of columnar arrays:
+            Period (p), LinkID (m), TotalFlow (p),
+            EstFlow, Congestion, Speed, TravelTime (p x m)
+        """
+        nodeIds = np.union1d(self.dfLink.Node1, self.dfLink.Node2)
+        n = len(nodeIds)
+        m = len(self.dfLink)
+        rows = np.searchsorted(nodeIds, self.dfLink.Node1.values)
+        cols = np.searchsorted(nodeIds, self.dfLink.Node2.values)
+        baseCapacity = self.dfLink['Capacity'].values.astype(float)
+        dist = self.dfLink['Distance'].values.astype(float)
+        pattern = ifn.linkMarkovPattern(rows, cols, n)
+        y = np.zeros(n)
+        y[-1] = 1
+
+        numPeriods = len(periods)
+        names = []
+        totalFlow = np.empty(numPeriods)
+        flows = np.empty((numPeriods, m))
+        congestions = np.empty((numPeriods, m))
+        speeds = np.empty((numPeriods, m))
+        travelTimes = np.empty((numPeriods, m))
+        lu = None
+        pi = None
+        previousCapacity = None
+        s = None
+        for p, period in enumerate(periods):
+            names.append(str(period.get("name", p)))
+            capacity = baseCapacity.copy()
+            if "capacity" in period:
+                change = pd.Series(period["capacity"], dtype=float)
+                change.index = change.index.astype(self.dfLink.index.dtype)
+                position = self.dfLink.index.get_indexer(change.index)
+                if np.any(position < 0):
+                    raise ValueError("capacity of period " + names[-1] + " has unknown LinkID: " +
+                                     ", ".join(map(str, change.index[position < 0])))
+                capacity[position] = change.values
+            if previousCapacity is None or not np.array_equal(capacity, previousCapacity):
+                s = ifn.linkStochastic(rows, capacity, n)
+                X = ifn.linkMarkovMatrix(pattern, s)
+                pi = None if lu is None else ifn.refineMarkov(X, lu, pi0=pi)
+                if pi is None:
+                    lu = splinalg.splu(X)
+                    pi = lu.solve(y)
+                previousCapacity = capacity
+            basisFlow = pi[rows] * s
+            basisCongestion = ifn.hadamardDivision(basisFlow, capacity)
+            if "total-flow" in period:
+                kappa = float(period["total-flow"])
+            elif "max-allowable-congestion" in period:
+                kappa = float(period["max-allowable-congestion"]) / np.max(basisCongestion)
+            else:
+                kappa = self.kappa if self.kappa is not None else 1
+            totalFlow[p] = kappa
+            flows[p] = kappa * basisFlow
+            congestions[p] = kappa * basisCongestion
+            travelTimes[p] = self.linkTravelTime(congestions[p])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                speeds[p] = np.where(travelTimes[p] > 0, dist / travelTimes[p], 0)
+        return {'Period': np.array(names), 'LinkID': self.dfLink.index.values, 'TotalFlow': totalFlow,
+                'EstFlow': flows, 'Congestion': congestions, 'Speed': speeds, 'TravelTime': travelTimes}
+
+    def linkTravelTime(self, congestion, dfLink=None):
+        """
+        return travel time (hour) of each link of dfLink (default: the scenario dfLink)
+        at the given congestion by the travel cost model:
+        BPR (alpha, beta from travel-cost-parameters, default 15, 4)
+        or Greenshield (congestion above 1 is taken as 1)
+        """
+        if dfLink is None:
+            dfLink = self.dfLink
+        dist = dfLink['Distance'].values.astype(float)
+        maxSpeed = dfLink['MaxSpeed'].values.astype(float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            minTravelTime = dist / maxSpeed  # t0 in hour
+            if self.travel_cost_model == 'Greenshield':
+                speed = maxSpeed / 2 * (1 + np.sqrt(1 - np.minimum(congestion, 1)))
+                return dist / speed
+            parameters = self.travel_cost_model_parameters or {}
+            alpha = parameters.get('alpha', 15)
+            beta = parameters.get('beta', 4)
+            return minTravelTime * (1 + alpha * congestion ** beta)
+
+    def capacitySensitivity(self, outputs=("max-congestion", "total-delay"), links=(), kappa=None):
+        """
+        gradient of network outputs with respect to the capacity of each link
+        at the total flow kappa (default: the calibrated kappa of the scenario),
+        by the adjoint of the Markov system (see ifn.linkFlowSensitivity):
+        one sparse LU factorization and one transposed solve per output.
+        outputs:
+            "max-congestion": max of flow / capacity (gradient of the link with the max congestion)
+            "total-delay": sum of flow * (travel time - free flow travel time) in pcu hour
+            "total-travel-time": sum of flow * travel time in pcu hour
+        links = LinkIDs, the output is the flow of the link
+        the gradients are added to self.dfLink as MaxCongestionGradient, TotalDelayGradient,
+        TotalTravelTimeGradient and FlowGradient_<LinkID>, e.g. the link with the most negative
+        MaxCongestionGradient is the capacity upgrade that most reduces the max congestion.
+        The total flow is kept, thus under max-congestion calibration (where kappa changes with
+        the capacity) the gradients are those of the same total flow.
 
+        Returns
+        -------
+        dfGradient : DataFrame
+            index LinkID, one column of gradient per output
+        """
+        if self.networks['network-0'].is_contract:
+            print("sensitivity of a contracted network is not supported")
+            return None
+        kappa = self.kappa if kappa is None else kappa
+        self.nodeIds = list(np.union1d(self.dfLink.Node1, self.dfLink.Node2))
+        r, c = self.linkNodeIndex()
+        capacity = self.dfLink.Capacity.values.astype(float)
+        m = len(capacity)
+
+        # travel time and its derivative with respect to congestion
+        dist = self.dfLink['Distance'].values.astype(float)
+        maxSpeed = self.dfLink['MaxSpeed'].values.astype(float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            minTravelTime = dist / maxSpeed  # t0 in hour
+            if self.travel_cost_model == 'Greenshield':
+                def derivative(g):
+                    root = np.sqrt(np.maximum(1 - g, 0))
+                    return np.where(g < 1, dist / (maxSpeed / 2) / (1 + root) ** 2 / (2 * root), np.nan)
+            else:
+                parameters = self.travel_cost_model_parameters or {}
+                alpha = parameters.get('alpha', 15)
+                beta = parameters.get('beta', 4)
 
+                def derivative(g):
+                    return minTravelTime * alpha * beta * g ** (beta - 1)
+        cloudNode = self.networks['network-0'].cloud_node_id
+        isUsed = np.ones(m, dtype=bool)
+        if cloudNode is not None:
+            isUsed = ~((self.dfLink.Node1.astype(str) == str(cloudNode)).values |
+                       (self.dfLink.Node2.astype(str) == str(cloudNode)).values)
+
+        names = []
+        direct = []
+
+        def outputGradient(flow):
+            # dJ/dflow of each output, and the direct dJ/dcapacity
+            g = ifn.hadamardDivision(flow, capacity)
+            with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+                travelTime = self.linkTravelTime(g)
+                dTravelTime = derivative(g)
+            isFinite = isUsed & np.isfinite(travelTime) & np.isfinite(dTravelTime)
+            travelTime = np.where(isFinite, travelTime, 0)
+            dTravelTime = np.where(isFinite, dTravelTime, 0)
+            delay = np.where(isFinite, travelTime - minTravelTime, 0)
+            capacityInverse = np.divide(1, capacity, out=np.zeros(m), where=capacity > 0)
+            dJdf = []
+            for output in outputs:
+                if output == "max-congestion":
+                    k = np.argmax(g)
+                    gradient = np.zeros(m)
+                    gradient[k] = capacityInverse[k]
+                    partial = np.zeros(m)
+                    partial[k] = -g[k] * capacityInverse[k]
+                    names.append("MaxCongestionGradient")
+                elif output in ("total-delay", "total-travel-time"):
+                    # J = sum(flow * t(flow / capacity)) (minus free flow travel time for the delay)
+                    gradient = (delay if output == "total-delay" else travelTime) + g * dTravelTime
+                    partial = -g ** 2 * dTravelTime
+                    names.append("TotalDelayGradient" if output == "total-delay" else "TotalTravelTimeGradient")
+                else:
+                    raise ValueError("unknown sensitivity output " + str(output))
+                dJdf.append(gradient)
+                direct.append(partial)
+            for linkId in links:
+                gradient = np.zeros(m)
+                gradient[self.dfLink.index.get_loc(linkId)] = 1
+                dJdf.append(gradient)
+                direct.append(np.zeros(m))
+                names.append("FlowGradient_" + str(linkId))
+            return np.array(dJdf)
+
+        flow, gradient = ifn.linkFlowSensitivity(r, c, capacity, outputGradient, kappa, numNodes=len(self.nodeIds))
+        gradient = np.atleast_2d(gradient) + np.array(direct)
+        dfGradient = pd.DataFrame(gradient.T, index=self.dfLink.index, columns=names)
+        for name in names:
+            self.dfLink[name] = dfGradient[name].values
+        return dfGradient
+
+    def runEquilibrium(self, theta=60, max_iteration=100, tolerance=1e-4, kappa=None, min_share=1e-3):
+        """
+        stochastic equilibrium: the link choice at each node is proportional to
+            capacity * exp(-theta * travelTime)
+        with travel time (hour) of the travel cost model at the current congestion,
+        theta in 1/hour (theta=0 gives the ideal flow of the capacity). The ideal flow of the weighted network and the link flow
+        are iterated by self-regulated averages
+            F = F + (Faux - F) / stepInverse
+        where stepInverse grows by 1.5 when the gap increases and by 0.1 otherwise,
+        until the relative gap sum|Faux-F|/sum(F) < tolerance.
+        The link choice is normalized in the log domain and every link keeps at least
+        min_share of the choice at its start node, thus the network stays strongly
+        connected and the Markov system well conditioned.
+        Every iteration fills the same sparse Markov system and is solved by GMRES
+        preconditioned by the LU factorization of an earlier iteration, which is renewed
+        only when GMRES does not converge. Each Markov vector is checked (residual and
+        non-negative), otherwise RuntimeError is raised.
+        kappa = total flow (default: the calibrated kappa of the scenario)
+        add EqFlow, EqCongestion, EqTravelTime to dfLink
+        (a warning is given if the gap does not reach tolerance in max_iteration)
+        return dictionary of iterations, gap, converged, factorizations and the gap history
+        """
+        if kappa is None:
+            kappa = self.kappa if self.kappa is not None else 1
+        nodeIds = np.union1d(self.dfLink.Node1, self.dfLink.Node2)
+        n = len(nodeIds)
+        rows = np.searchsorted(nodeIds, self.dfLink.Node1.values)
+        cols = np.searchsorted(nodeIds, self.dfLink.Node2.values)
+        capacity = self.dfLink['Capacity'].values.astype(float)
+        pattern = ifn.linkMarkovPattern(rows, cols, n)
+        y = np.zeros(n)
+        y[-1] = 1
+        numLinks = np.bincount(rows, minlength=n)
+        logCapacity = np.log(np.where(capacity > 0, capacity, 1))
+        state = {'lu': None, 'factorizations': 0}
+
+        def solve(X, pi0):
+            # Markov vector of X, checked for residual and sign
+            if state['lu'] is not None:
+                preconditioner = splinalg.LinearOperator((n, n), matvec=state['lu'].solve)
+                pi, info = splinalg.gmres(X, y, x0=pi0, M=preconditioner, rtol=1e-12, atol=0, restart=20, maxiter=5)
+                pi = markovVector(X, pi) if info == 0 else None
+                if pi is not None:
+                    return pi
+            state['lu'] = splinalg.splu(X)
+            state['factorizations'] = state['factorizations'] + 1
+            pi = markovVector(X, state['lu'].solve(y))
+            if pi is None:
+                raise RuntimeError("equilibrium Markov system is ill-conditioned (theta = " + str(theta) +
+                                   "), use a smaller theta or a larger min_share")
+            return pi
+
+        def markovVector(X, pi):
+            # negative values within the accuracy of the solve are taken as zero:
+            # the non-negative vector must solve the Markov system
+            pi = np.maximum(pi, 0)
+            pi = pi / np.sum(pi)
+            return pi if np.sum(np.abs(X.dot(pi) - y)) < 1e-8 else None
+
+        def choice(weightLog):
+            # stochastic value of each link from log weights, at least min_share of its start node
+            maxLog = np.full(n, -np.inf)
+            np.maximum.at(maxLog, rows, weightLog)
+            s = ifn.linkStochastic(rows, np.where(capacity > 0, np.exp(weightLog - maxLog[rows]), 0), n)
+            floor = np.minimum(min_share, 1 / numLinks[rows])
+            s = np.where(capacity > 0, np.maximum(s, floor), 0)
+            return ifn.linkStochastic(rows, s, n)
+
+        # start from the ideal flow of the capacity
+        s = ifn.linkStochastic(rows, capacity, n)
+        pi = solve(ifn.linkMarkovMatrix(pattern, s), None)
+        F = kappa * pi[rows] * s
+        history = []
+        gap = np.inf
+        iteration = 0
+        stepInverse = 1.0
+        while iteration < max_iteration:
+            iteration = iteration + 1
+            congestion = ifn.hadamardDivision(F, capacity)
+            travelTime = np.nan_to_num(self.linkTravelTime(congestion), nan=0.0, posinf=1e6)
+            s = choice(logCapacity - theta * travelTime)
+            pi = solve(ifn.linkMarkovMatrix(pattern, s), pi)
+            Faux = kappa * pi[rows] * s
+            gap = np.sum(np.abs(Faux - F)) / np.sum(F)
+            history.append(gap)
+            if gap < tolerance:
+                break
+            # self-regulated averaging: the step shrinks fast only when the gap grows
+            if len(history) > 1:
+                stepInverse = stepInverse + (1.5 if history[-1] >= history[-2] else 0.1)
+            F = F + (Faux - F) / stepInverse
+
+        congestion = ifn.hadamardDivision(F, capacity)
+        self.dfLink['EqFlow'] = F
+        self.dfLink['EqCongestion'] = congestion
+        self.dfLink['EqTravelTime'] = self.linkTravelTime(congestion)
+        report = {'iterations': iteration, 'gap': gap, 'converged': gap < tolerance,
+                  'factorizations': state['factorizations'], 'history': history}
+        print("equilibrium:", {key: value for key, value in report.items() if key != 'history'})
+        if not report['converged']:
+            warnings.warn("equilibrium did not converge in " + str(max_iteration) + " iterations (gap " +
+                          "{:.2e}".format(gap) + " > tolerance " + str(tolerance) + ")")
+        return report
 
     def computeLinkPerformance(self):
         """
         return mLink with additional link performance
-
+        (elementwise over the links, thus it can be refreshed at every new congestion)
         """
-        travelTimeModel = self.travel_cost_model
         cloudNode = self.networks['network-0'].cloud_node_id
-        mR, mC = self.dfLink.shape
-        arrSpeed = []
-        arrTravelTime = []
-        arrDelay = []
-        for index, row in self.dfLink.iterrows():
-            node1 = row.Node1
-            node2 = row.Node2
-            if cloudNode is not None and (cloudNode == str(node1) or cloudNode == str(node2)):
-                speed = np.nan  # v
-                travelTime = np.nan  # t
-                minTravelTime = np.nan  # t0
-                delay = np.nan  # delta
-            else:
-                maxSpeed = row.MaxSpeed  # u in km/hour
-                dist = row.Distance  # d in km; mLink[4,j] in km
-                congestion = row.Congestion  # g
-
-                if travelTimeModel == 'Greenshield':
-                    # based on greenshield
-                    if congestion <= 1:
-                        speed = maxSpeed / 2 * (1 + math.sqrt(1 - congestion))  # v in km/hour
-                        if speed > 0:
-                            travelTime = dist / speed  # t   in hour
-                        else:
-                            travelTime = np.inf
-                        if maxSpeed > 0:
-                            minTravelTime = dist / maxSpeed  # t0  in hour
-                        else:
-                            minTravelTime = np.inf
-                        delay = travelTime - minTravelTime  # delta in hour
-                    else:
-                        speed = 0
-                        travelTime = np.inf
-                        minTravelTime = np.inf
-                        delay = np.inf
-                else:
-                    # based on BPR (by default)
-                    minTravelTime = dist / maxSpeed  # t0  in hour
-                    travelTime = minTravelTime * (1 + 15 * congestion ** 4)  # t in hour
-                    if travelTime > 0:
-                        speed = dist / travelTime  # v  in km/hour
-                    else:
-                        speed = 0
-                    delay = travelTime - minTravelTime  # delta in hour
-
-            arrSpeed.append(speed)
-            arrTravelTime.append(travelTime)
-            arrDelay.append(delay)
-
-        self.dfLink['Speed'] = arrSpeed
-        self.dfLink['TravelTime'] = arrTravelTime
-        self.dfLink['Delay'] = arrDelay
+        dist = self.dfLink['Distance'].values.astype(float)  # d in km
+        congestion = self.dfLink['Congestion'].values.astype(float)  # g
+        # travel cost model (BPR with travel-cost-parameters or Greenshield) of linkTravelTime
+        travelTime = self.linkTravelTime(congestion)  # t in hour
+        minTravelTime = self.linkTravelTime(np.zeros(len(congestion)))  # t0 in hour
+        if self.travel_cost_model == 'Greenshield':
+            # beyond the capacity the link is jammed
+            travelTime[congestion > 1] = np.inf
+        with np.errstate(divide='ignore', invalid='ignore'):
+            speed = np.where(travelTime > 0, dist / travelTime, 0)  # v in km/hour
+            delay = travelTime - minTravelTime  # delta in hour
+        if cloudNode is not None:
+            isCloud = (self.dfLink.Node1.astype(str) == str(cloudNode)).values | \
+                      (self.dfLink.Node2.astype(str) == str(cloudNode)).values
+            speed[isCloud] = np.nan
+            travelTime[isCloud] = np.nan
+            delay[isCloud] = np.nan
+
+        self.dfLink['Speed'] = speed
+        self.dfLink['TravelTime'] = travelTime
+        self.dfLink['Delay'] = delay
 
     def isStronglyConnectedNetwork(self):
         C = self.mLink2WeightedAdjacency(field='Capacity')  # capacity
@@ -337,127 +1379,336 @@ class Scenario():
             return "Your network is not strongly connected. Clean the network data either by finding the largest " \
                    "strongly connected component or add a cloud node and dummy links."
 
-    def mLink2WeightedAdjacency(self, field='Capacity'):
+    def mLink2WeightedAdjacency(self, field='Capacity', isSparse=False):
         """
         return capacity matrix (by default)
         but depending on the fieldNo, it can also return Dist,Lanes,MaxSpeed
+        if isSparse, return scipy sparse matrix.
+        The values of parallel links (same Node1 and Node2) are summed in both
+        the dense and the sparse matrix (e.g. the capacity between two nodes).
 
         assume fields in mLink at least contain
             LinkID,Node1,Node2,Capacity,Dist,MaxSpeed,....
 
         """
-        mLink = self.networks['network-0'].dfLink
+        mLink = self.networks['network-0'].solve_dfLink()
         # get unique node IDs from second and third fields of mLink
         self.nodeIds = list(np.union1d(mLink.Node1, mLink.Node2))
-        n = np.prod(len(self.nodeIds))
+        n = len(self.nodeIds)
+        r, c = self.linkNodeIndex()
+        k = mLink[field].values.astype(np.float64)
+        if isSparse:
+            return sparse.csr_matrix((k, (r, c)), shape=(n, n))
         A = np.zeros((n, n), dtype=np.float64)
-        # fill up with 1 when there is a link
-        coord = zip(mLink.Node1, mLink.Node2, mLink[field])
-        for item in coord:
-            (node1, node2, k) = item
-            r = self.nodeIds.index(node1)
-            c = self.nodeIds.index(node2)
-            A[int(r) - 1, int(c) - 1] = float(k)
+        # fill up with the field value when there is a link (sum of parallel links)
+        np.add.at(A, (r, c), k)
         return A
 
+    def linkNodeIndex(self):
+        """
+        return row and column index of each link of the solved network
+        in the matrices of the scenario (node order of self.nodeIds)
+        """
+        mLink = self.networks['network-0'].solve_dfLink()
+        if not self.nodeIds:
+            # get unique node IDs from second and third fields of mLink
+            self.nodeIds = list(np.union1d(mLink.Node1, mLink.Node2))
+        nodeIds = np.array(self.nodeIds)
+        r = np.searchsorted(nodeIds, mLink.Node1.values)
+        c = np.searchsorted(nodeIds, mLink.Node2.values)
+        return r, c
+
+    def solveMarkov(self, S, kappa=1):
+        """
+        return steady state Markov vector of stochastic matrix S
+        based on the solver of the model:
+            "dense" (default): pseudo inverse
+            "sparse": sparse direct solve
+            "partition": domain decomposition of the network into regions
+                         by node coordinates (or by graph partition)
+            "multilevel": multilevel aggregation cycles
+            "power": power iteration
+        the iterative solvers start from the warm start Markov vector if available,
+        if they do not converge, a warning is given and the sparse direct solve is used
+        """
+        if self.solver == "sparse":
+            return ifn.sparseMarkov(S, kappa)
+        elif self.solver in ("multilevel", "power"):
+            pi0 = None
+            if self.warm_start is not None:
+                pi0 = self.warm_start.reindex(self.nodeIds)
+                pi0 = pi0.fillna(pi0.mean()).values if pi0.notna().any() else None
+            tol = self.solver_parameters.get("tolerance", 1e-10)
+            if self.solver == "multilevel":
+                maxIter = self.solver_parameters.get("max-iteration", 100)
+                pi, info = ifn.multilevelMarkov(S, kappa, tol=tol, maxIter=maxIter, pi0=pi0)
+            else:
+                maxIter = self.solver_parameters.get("max-iteration", 100000)
+                pi, info = ifn.powerMarkov(S, kappa, tol=tol, maxIter=maxIter, pi0=pi0)
+                if not info['residual'] <= tol:
+                    warnings.warn("power solver did not converge in " + str(maxIter) + " iterations (residual " +
+                                  "{:.2e}".format(info['residual']) + "), sparse direct solve is used")
+                    pi = ifn.sparseMarkov(S, kappa)
+            print(self.solver, "solver:", info)
+            return pi
+        elif self.solver == "partition":
+            numBlocks = self.solver_parameters.get("blocks", 8)
+            workers = self.solver_parameters.get("workers", 1)
+            parts = self.partitionNodes(S, numBlocks)
+            pi, info = ifn.partitionMarkov(S, parts, kappa, workers=workers)
+            print("partition solver:", info)
+            return pi
+        return ifn.markov(S, kappa)
+
+    def partitionNodes(self, S, numBlocks):
+        """
+        return region label of each node (order of self.nodeIds)
+        based on node coordinates in dfNode,
+        or based on graph partition if the coordinates are not available
+        or "partition": "graph" in the solver parameters
+        """
+        dfNode = self.networks['network-0'].dfNode
+        if self.solver_parameters.get("partition", "coordinate") == "coordinate" and dfNode is not None:
+            xy = dfNode.reindex(self.nodeIds)
+            if not (xy.X.isna().any() or xy.Y.isna().any()):
+                return ifn.coordinatePartition(xy.X.values, xy.Y.values, numBlocks)
+        return ifn.graphPartition(S, numBlocks)
+
+    def loadRealFlow(self, file_name=None):
+        """
+        load real flow data (LinkID,Node1,Node2,ActualFlow) and join it to self.dfLink by LinkID.
+        Records are not used when the LinkID is not in the link file, when Node1 or Node2
+        disagree with the link file, or when ActualFlow is missing;
+        duplicated LinkIDs are reported and their ActualFlow is averaged.
+        The report is printed and saved as <scenario id>_realflow.csv when there is any problem.
+
+        Returns
+        -------
+        dfObs : DataFrame
+            index LinkID (unique, valid records only), columns of the real flow file and Position
+            (Position = row of the link in self.dfLink, to align arrays of link values)
+        dfReport : DataFrame
+            index LinkID, column Problem ("missing-link", "node-mismatch", "no-flow", "duplicate")
+        """
+        if file_name is None:
+            file_name = os.path.join(self.folder_path, self.data["flow"])
+        dfFlow = pd.read_csv(file_name, index_col='LinkID')
+
+        # one indexed join of the flow records to the link table
+        position = self.dfLink.index.get_indexer(dfFlow.index)
+        isFound = position >= 0
+        isMatch = np.zeros(len(dfFlow), dtype=bool)
+        isMatch[isFound] = (self.dfLink.Node1.values[position[isFound]].astype(str) ==
+                            dfFlow.Node1.values[isFound].astype(str)) & \
+                           (self.dfLink.Node2.values[position[isFound]].astype(str) ==
+                            dfFlow.Node2.values[isFound].astype(str))
+        flow = pd.to_numeric(dfFlow['ActualFlow'], errors='coerce').values
+        isFlow = np.isfinite(flow)
+        isDuplicate = dfFlow.index.duplicated(keep=False)
+        problems = [("missing-link", ~isFound), ("node-mismatch", isFound & ~isMatch),
+                    ("no-flow", isMatch & ~isFlow), ("duplicate", isDuplicate)]
+        dfReport = pd.DataFrame({'Problem': np.concatenate([np.repeat(name, np.sum(mask)) for name, mask in problems])},
+                                index=pd.Index(np.concatenate([dfFlow.index.values[mask] for _, mask in problems]),
+                                               name='LinkID'))
+
+        isValid = isMatch & isFlow
+        dfObs = dfFlow[isValid].copy()
+        dfObs['ActualFlow'] = flow[isValid]
+        dfObs['Position'] = position[isValid]
+        if dfObs.index.has_duplicates:
+            aggregation = {field: 'first' for field in dfObs.columns}
+            aggregation['ActualFlow'] = 'mean'
+            dfObs = dfObs.groupby(level=0, sort=False).agg(aggregation)
+        if len(dfReport) > 0:
+            print(str(len(dfFlow)) + " real flow records: " + str(len(dfObs)) + " links used, " +
+                  ", ".join(name + " = " + str(int(np.sum(mask))) for name, mask in problems))
+            report_file_name = os.path.join(self.folder_path, self.id + "_realflow.csv")
+            dfReport.to_csv(report_file_name)
+            print("real flow report saved in", report_file_name)
+        return dfObs, dfReport
+
+    def calibrateCapacity(self, by=None, regularization=None, bounds=None):
+        """
+        calibrate the capacity of each link (by="link") or one capacity multiplier
+        per value of a link field (e.g. by="RoadType") such that the ideal flow fits
+        the real flow on the counted links (see ifn.calibrateCapacity).
+        The defaults are from calibration-parameter: "capacity", "regularization" (0.01),
+        "bounds" of the multipliers ([0.1, 10]) and "weight" (column of the real flow file).
+        Add CapacityMultiplier, CalibratedCapacity and CalibratedFlow to self.dfLink.
+
+        Returns
+        -------
+        info : dictionary of the multipliers, kappa (total flow), objective and iterations
+            None if no real flow record matches the link file
+        """
+        parameter = self.calibration_parameter or {}
+        by = parameter.get("capacity", "link") if by is None else by
+        regularization = parameter.get("regularization", 0.01) if regularization is None else regularization
+        bounds = parameter.get("bounds", [0.1, 10]) if bounds is None else bounds
+        if self.networks['network-0'].is_contract:
+            print("capacity calibration of a contracted network is not supported, capacity is not changed")
+            return None
+        dfObs, _ = self.loadRealFlow()
+        if len(dfObs) == 0:
+            print("no real flow record matches the link file, capacity is not changed")
+            return None
+
+        self.nodeIds = list(np.union1d(self.dfLink.Node1, self.dfLink.Node2))
+        r, c = self.linkNodeIndex()
+        observed = np.full(len(self.dfLink), np.nan)
+        observed[dfObs.Position.values] = dfObs.ActualFlow.values
+        weights = None
+        if "weight" in parameter:
+            weights = np.ones(len(self.dfLink))
+            weights[dfObs.Position.values] = dfObs[parameter["weight"]].values.astype(float)
+        if by == "link":
+            groups, labels = np.arange(len(self.dfLink)), self.dfLink.index.values
+        else:
+            groups, labels = pd.factorize(self.dfLink[by].fillna("unknown"))
+        capacity, flow, info = ifn.calibrateCapacity(r, c, self.dfLink.Capacity.values.astype(float), observed,
+                                                     groups=groups, weights=weights,
+                                                     regularization=regularization, bounds=bounds,
+                                                     numNodes=len(self.nodeIds))
+        self.dfLink['CapacityMultiplier'] = info['multiplier'][groups]
+        self.dfLink['CalibratedCapacity'] = capacity
+        self.dfLink['CalibratedFlow'] = flow
+        isCounted = np.isfinite(observed)
+        fit = ifn.goodnessOfFit(flow[isCounted], observed[isCounted])
+        print("capacity calibration by " + str(by) + ": " + str(info['iterations']) + " iterations, " +
+              "; ".join(key + " = " + str(round(float(value), 4)) for key, value in fit.items()))
+        if by != "link":
+            print(pd.Series(info['multiplier'], index=labels, name='CapacityMultiplier').to_string())
+        info['fit'] = fit
+        return info
+
     def findOptScaling(self):
         """
-        search for optimal scaling factor
+        search for optimal scaling factor of the basis flow to the real flow
+        by the criterion in calibration-parameter (default: SSE)
 
         Returns
         -------
         opt_scaling : float
             optimal scaling factor
-        opt_Rsq : float
-            R^2 at optimal scaling
-        dicRsq : dictionary             to compute R^2
-        dicSSE : dictionary             to compute SSE
+        opt_SSE : float
+            SSE at optimal scaling
+        dicRsq : dictionary             R^2 of scaling around the optimum (to plot)
+        dicSSE : dictionary             SSE of scaling around the optimum (to plot)
         SST : float
             Sum Square Total (to be used to compute R^2)
 
+        None if no real flow record matches the link file
         """
-        # get real flow data
-        real_flow_file_name = self.data["flow"]
-        dfFlow = pd.read_csv(os.path.join(self.folder_path, real_flow_file_name), index_col='LinkID')
-
-        # Check if all links in actual flow match the link file
-        for linkID, row in dfFlow.iterrows():
-            a_link = self.dfLink.loc[linkID]
-            if not (a_link.Node1 == row.Node1 and a_link.Node2 == row.Node2):
-                return None
+        # get real flow data aligned with the links
+        dfObs, _ = self.loadRealFlow()
+        if len(dfObs) == 0:
+            return None
 
         if "BasisFlow" not in self.dfLink:
             C = self.mLink2WeightedAdjacency(field='Capacity')
             F = ifn.capacity2idealFlow(C)
             self.addField2dfLink(F, "BasisFlow")
 
-        avgScale = 0
-        count = 0
-        avgFlow = 0
-        for linkID, row in dfFlow.iterrows():
-            basis = self.dfLink["BasisFlow"].loc[linkID]
-            flow = row["ActualFlow"]
-            scaling = flow / basis
-            count = count + 1
-            avgScale = (count - 1) / count * avgScale + scaling / count
-            avgFlow = (count - 1) / count * avgFlow + flow / count
-            # print('linkID',linkID,'basis',basis,'flow',flow,'scaling',scaling,'avgScale',avgScale)
-
-        SST = 0
-        for linkID, row in dfFlow.iterrows():
-            flow = row["ActualFlow"]
-            SST = SST + math.pow(flow - avgFlow, 2)
-        # print('SST',SST)
-
-        dicSSE = {}
-        dicRsq = {}
-        for scale in range(int(avgScale) - 2500, int(avgScale) + 2500):
-            SSE = 0
-            for linkID, row in dfFlow.iterrows():
-                basis = self.dfLink["BasisFlow"].loc[linkID]
-                flow = row["ActualFlow"]
-                estFlow = scale * basis
-                sqErr = math.pow(flow - estFlow, 2)
-                SSE = SSE + sqErr
-            if SST > 0:
-                Rsq = 1 - SSE / SST
-            else:
-                Rsq = 1  # actually undefined when SST=1 (i.e. only one data)
-            dicRsq[scale] = Rsq
-            dicSSE[scale] = SSE
+        basis = self.dfLink["BasisFlow"].values[dfObs.Position.values]
+        flow = dfObs.ActualFlow.values
+        parameter = dict(self.calibration_parameter or {})
+        criterion = parameter.pop("criterion", "SSE")
+        field = parameter.pop("weight", None)
+        weights = dfObs[field].values.astype(float) if field is not None else None
+        opt_scaling, opt_value = ifn.optimalScaling(basis, flow, criterion, weights, **parameter)
+        self.calibration_fit = ifn.goodnessOfFit(opt_scaling * basis, flow)
+        self.calibration_fit['Objective'] = opt_value  # value of the criterion at the optimum
+
+        # SSE(scale) = sum(flow^2) - 2 scale sum(flow*basis) + scale^2 sum(basis^2)
+        SST = np.sum((flow - np.mean(flow)) ** 2)
+        scales = np.linspace(0.5, 1.5, 1001) * opt_scaling
+        arrSSE = np.sum(flow ** 2) - 2 * scales * np.dot(flow, basis) + scales ** 2 * np.dot(basis, basis)
+        arrSSE = np.maximum(arrSSE, 0)
+        arrRsq = 1 - arrSSE / SST if SST > 0 else np.ones(len(scales))  # undefined when only one data
+        dicRsq = dict(zip(scales.tolist(), arrRsq.tolist()))
+        dicSSE = dict(zip(scales.tolist(), arrSSE.tolist()))
+        return opt_scaling, self.calibration_fit['SSE'], dicRsq, dicSSE, SST
+
+    def resampleScaling(self, numSamples=1000, station=None, level=0.95, seed=0, workers=1):
+        """
+        stability of the optimal scaling factor with respect to the count stations:
+        bootstrap of numSamples resamples of the stations and leave-one-station-out
+        (see ifn.bootstrapScaling and ifn.leaveOneOutScaling), by the criterion of calibration-parameter.
+        station = column of the real flow file with the station of each count (default: each LinkID)
+        The congestion of each resample is scaling * BasisFlow / Capacity;
+        CongestionLower and CongestionUpper (confidence interval at level) are added to self.dfLink
+        and the resamples are saved as <scenario id>_resample.csv
 
-        # opt_scaling = max(dicRsq, key=dicRsq.get)
-        # opt_Rsq = dicRsq[opt_scaling]
-        opt_scaling = min(dicSSE, key=dicSSE.get)
-        opt_SSE = dicSSE[opt_scaling]
-        return opt_scaling, opt_SSE, dicRsq, dicSSE, SST
+        Returns
+        -------
+        dfResample : DataFrame
+            columns Method ("bootstrap" or "leave-one-out"), Station (left out), Scaling, MaxCongestion,
+            Error (squared error of the left out counts)
+        """
+        dfObs, _ = self.loadRealFlow()
+        if len(dfObs) == 0:
+            print("no real flow record matches the link file")
+            return None
+        basis = self.dfLink["BasisFlow"].values[dfObs.Position.values]
+        flow = dfObs.ActualFlow.values
+        parameter = self.calibration_parameter or {}
+        criterion = parameter.get("criterion", "SSE")
+        weights = dfObs[parameter["weight"]].values.astype(float) if "weight" in parameter else None
+        if station is None:
+            groups, stations = np.arange(len(dfObs)), dfObs.index.values
+        else:
+            groups, stations = pd.factorize(dfObs[station])
+
+        bootstrap = ifn.bootstrapScaling(basis, flow, numSamples, criterion, weights, groups, seed=seed,
+                                         workers=workers)
+        leaveOut, errors = ifn.leaveOneOutScaling(basis, flow, criterion, weights, groups)
+        unitCongestion = ifn.hadamardDivision(self.dfLink["BasisFlow"].values,
+                                              self.dfLink["Capacity"].values.astype(float))
+        maxUnitCongestion = np.max(unitCongestion)
+        dfResample = pd.DataFrame({'Method': np.repeat(["bootstrap", "leave-one-out"], [numSamples, len(stations)]),
+                                   'Station': np.concatenate([np.full(numSamples, None), stations]),
+                                   'Scaling': np.concatenate([bootstrap, leaveOut]),
+                                   'Error': np.concatenate([np.full(numSamples, np.nan), errors])})
+        dfResample['MaxCongestion'] = dfResample['Scaling'] * maxUnitCongestion
+        file_name = os.path.join(self.folder_path, self.id + "_resample.csv")
+        dfResample.to_csv(file_name, index=False)
+
+        lower, upper = np.quantile(bootstrap, [(1 - level) / 2, (1 + level) / 2])
+        self.dfLink['CongestionLower'] = lower * unitCongestion
+        self.dfLink['CongestionUpper'] = upper * unitCongestion
+        print("bootstrap of " + str(len(stations)) + " stations: scaling = " + str(np.mean(bootstrap)) +
+              " +- " + str(np.std(bootstrap)) + ", " + str(round(100 * level)) + "% interval = [" +
+              str(lower) + ", " + str(upper) + "], max congestion = [" + str(round(lower * maxUnitCongestion, 4)) +
+              ", " + str(round(upper * maxUnitCongestion, 4)) + "]")
+        print("leave-one-station-out: scaling = [" + str(np.nanmin(leaveOut)) + ", " + str(np.nanmax(leaveOut)) +
+              "], prediction RMSE = " + str(np.sqrt(np.sum(errors) / len(flow))))
+        print("resamples saved in", file_name)
+        return dfResample
 
     def find_optimum_scaling(self):
-        opt_scaling, opt_SSE, dicRsq, dicSSE, SST = self.findOptScaling()
+        result = self.findOptScaling()
+        if result is None:
+            print("no real flow record matches the link file, scaling factor is not changed")
+            return
+        opt_scaling, opt_SSE, dicRsq, dicSSE, SST = result
         self.scalingFactor = opt_scaling
 
-        # if self.calibration_parameter["criterion"] == "R^2":
-        x = dicRsq.keys()
-        y = dicRsq.values()
-        opt_scale = max(dicRsq, key=dicRsq.get)
-        opt_Rsq = dicRsq[opt_scale]
+        # R^2 plot
+        x = list(dicRsq.keys())
+        y = list(dicRsq.values())
         plt.figure()
-        plt.plot(x, y, opt_scale, opt_Rsq, 'or')
+        plt.plot(x, y, opt_scaling, 1 - opt_SSE / SST if SST > 0 else 1, 'or')
         plt.xlabel("scaling")
         plt.ylabel("R-Square")
-        # if self.calibration_parameter["criterion"] == "SSE":
         # SSE plot
         plt.figure()
-        x = dicSSE.keys()
-        y = dicSSE.values()
-        opt_scale = min(dicSSE, key=dicSSE.get)
-        optSSE = dicSSE[opt_scale]
-        plt.plot(x, y, opt_scale, optSSE, 'or')
+        x = list(dicSSE.keys())
+        y = list(dicSSE.values())
+        plt.plot(x, y, opt_scaling, opt_SSE, 'or')
         plt.xlabel("scaling")
         plt.ylabel("SSE")
-        # print(opt_scaling, opt_SSE)
-        # print('Optimum scaling = ' + str(opt_scaling) + '; Optimum R-square = ' + str(round(opt_Rsq, 4)))
-        print('Optimum scaling = ' + str(opt_scaling) + '; Min-SSE = ' + str(round(opt_SSE, 4)))
+        print('Optimum scaling = ' + str(opt_scaling) + '; ' +
+              '; '.join(key + ' = ' + str(round(float(value), 4)) for key, value in self.calibration_fit.items()))
 
 
 class Network():
@@ -474,9 +1725,14 @@ class Network():
         self.graph_file_name = ""
         self.cloud_node_id = ""
         self.network_weight = 1
+        self.is_contract = False  # collapse chains of pass-through nodes before solving (true, "one-way" or "two-way")
         self.nodeIds = None
         self.dfLink = None
         self.dfNode = None
+        self.dfLinkContracted = None  # link table of the contracted network
+        self.linkChain = None  # original LinkID -> contracted LinkID
+        self.area = None  # bbox [xmin, ymin, xmax, ymax] or polygon [[x, y], ...] of the extracted sub-network
+        self.spatial_index = None  # built on the first spatial query (see build_spatial_index)
 
         # initial command
         self.parse_network_dictionary()
@@ -490,7 +1746,8 @@ class Network():
             "\n\tlink_file_name = " + str(self.link_file_name) + \
             "\n\tgraph_file_name = " + str(self.graph_file_name) + \
             "\n\tcloud_node_id = " + str(self.cloud_node_id) + \
-            "\n\tnetwork_weight = " + str(self.network_weight)
+            "\n\tnetwork_weight = " + str(self.network_weight) + \
+            "\n\tcontract = " + str(self.is_contract)
 
     def parse_network_dictionary(self):
         """
@@ -524,19 +1781,303 @@ class Network():
             self.dfLink = pd.read_csv(link_file_name, index_col='LinkID')
 
         # extract graph_file_name
+        # graph (osmnx graphml or binary cache graph.npz) is used when node and link files are not given
         if "graph" in self.dict_network:
             self.graph_file_name = self.dict_network["graph"]
+            if self.dfLink is None:
+                graph_file_name = os.path.join(self.folder_path, self.graph_file_name)
+                print("loading graph:", graph_file_name)
+                self.load_graph(graph_file_name)
 
         # extract cloud_node_id
         if "cloud" in self.dict_network:
             self.cloud_node_id = self.dict_network["cloud"]
 
+        # extract sub-network inside a bbox or polygon; boundary links are connected to a cloud node
+        if "area" in self.dict_network and self.dfLink is not None:
+            self.area = self.dict_network["area"]
+            net = self.subnetwork(self.area, self.cloud_node_id or None)
+            self.dfNode, self.dfLink, self.cloud_node_id = net.dfNode, net.dfLink, net.cloud_node_id
+            self.spatial_index = None
+
         # extract network_weight
         if "weight" in self.dict_network:
             self.network_weight = self.dict_network["weight"]
         else:
             self.network_weight = 1
 
+        # extract contraction of pass-through nodes
+        # true (or "one-way"): contract nodes with one link in and one link out, the flow is exact;
+        # "two-way": also contract the middle of two-way roads, which changes the flow (no U-turns)
+        if "contract" in self.dict_network:
+            self.is_contract = self.dict_network["contract"]
+        if self.is_contract and self.dfLink is not None:
+            self.contract_chains(isTwoWay=self.is_contract == "two-way")
+
+    def contract_chains(self, isTwoWay=False):
+        """
+        collapse chains of pass-through nodes into super-links.
+        A pass-through node has either one link in and one link out,
+        or (if isTwoWay) it is in the middle of a two-way road (links in and out of
+        the same two neighbor nodes). Each chain is replaced by one link with
+        Capacity = minimum capacity along the chain (for congestion)
+        EntryCapacity = capacity of the first link (for the link choice at the start of the chain)
+        Distance = sum of distance along the chain
+        MaxSpeed = such that free flow travel time is the sum along the chain
+        Contracting one-way chains keeps the flow exactly. Contracting two-way chains
+        is lossy: U-turns in the middle of a two-way road are not possible in the
+        contracted network, thus it changes the flow and congestion of the network.
+        A chain is kept when its super-link would duplicate an existing link.
+
+        Returns
+        -------
+        dfLinkContracted : DataFrame
+            link table of the contracted network
+        linkChain : Series
+            index = original LinkID, value = LinkID in dfLinkContracted
+        """
+        dfLink = self.dfLink
+        node1 = dfLink.Node1.values
+        node2 = dfLink.Node2.values
+        linkIds = dfLink.index.values
+        cloud = str(self.cloud_node_id)
+
+        # find pass-through nodes and the successor of each link entering such node
+        dicOut = {}
+        dicIn = {}
+        for j in range(len(linkIds)):
+            dicOut.setdefault(node1[j], []).append(j)
+            dicIn.setdefault(node2[j], []).append(j)
+        successor = {}
+        for node, lstIn in dicIn.items():
+            lstOut = dicOut.get(node, [])
+            if str(node) == cloud or len(lstIn) != len(lstOut) or len(lstIn) not in (1, 2):
+                continue
+            nodesIn = {node1[j] for j in lstIn}
+            nodesOut = {node2[j] for j in lstOut}
+            if node in nodesIn or len(nodesIn) != len(lstIn):
+                continue  # self loop or parallel links
+            if len(lstIn) == 1:
+                if nodesIn == nodesOut:
+                    continue  # dead end
+                successor[lstIn[0]] = lstOut[0]
+            elif isTwoWay and nodesIn == nodesOut:
+                for j in lstIn:
+                    successor[j] = [k for k in lstOut if node2[k] != node1[j]][0]
+
+        # follow the chains from links leaving non pass-through nodes
+        isPassThrough = {node1[j] for j in successor.values()}
+        chains = []
+        isUsed = np.zeros(len(linkIds), dtype=bool)
+        for j in range(len(linkIds)):
+            if node1[j] in isPassThrough:
+                continue
+            chain = [j]
+            while chain[-1] in successor:
+                chain.append(successor[chain[-1]])
+            chains.append(chain)
+            isUsed[chain] = True
+        # links on a loop of pass-through nodes only are kept as they are
+        chains.extend([j] for j in np.flatnonzero(~isUsed))
+
+        # keep the chain when the super-link duplicates another link
+        setPairs = {(node1[chain[0]], node2[chain[0]]) for chain in chains if len(chain) == 1}
+        lstChains = []
+        for chain in chains:
+            pair = (node1[chain[0]], node2[chain[-1]])
+            if len(chain) > 1 and pair in setPairs:
+                lstChains.extend([j] for j in chain)
+            else:
+                setPairs.add(pair)
+                lstChains.append(chain)
+
+        # super-links attributes
+        chainOf = np.empty(len(linkIds), dtype=np.int64)
+        for idx, chain in enumerate(lstChains):
+            chainOf[chain] = idx
+        first = np.array([chain[0] for chain in lstChains])
+        last = np.array([chain[-1] for chain in lstChains])
+        capacity = dfLink.Capacity.values.astype(float)
+        distance = dfLink.Distance.values.astype(float)
+        maxSpeed = dfLink.MaxSpeed.values.astype(float)
+        minCapacity = np.full(len(lstChains), np.inf)
+        np.minimum.at(minCapacity, chainOf, capacity)
+        sumDistance = np.bincount(chainOf, weights=distance, minlength=len(lstChains))
+        sumFreeFlowTime = np.bincount(chainOf, weights=distance / maxSpeed, minlength=len(lstChains))
+        dfLinkContracted = dfLink.iloc[first].copy()
+        dfLinkContracted['Node2'] = node2[last]
+        dfLinkContracted['Capacity'] = minCapacity
+        dfLinkContracted['EntryCapacity'] = capacity[first]
+        dfLinkContracted['Distance'] = sumDistance
+        dfLinkContracted['MaxSpeed'] = np.divide(sumDistance, sumFreeFlowTime, where=sumFreeFlowTime > 0,
+                                                 out=dfLinkContracted['MaxSpeed'].values.astype(float))
+        dfLinkContracted['ChainLength'] = [len(chain) for chain in lstChains]
+        dfLinkContracted.index = pd.Index(np.arange(1, len(lstChains) + 1), name=dfLink.index.name)
+        self.dfLinkContracted = dfLinkContracted
+        self.linkChain = pd.Series(chainOf + 1, index=dfLink.index, name='ChainID')
+        print("contracted network: " + str(len(np.union1d(node1, node2))) + " nodes, " + str(len(linkIds)) +
+              " links into " + str(len(np.union1d(dfLinkContracted.Node1, dfLinkContracted.Node2))) + " nodes, " +
+              str(len(dfLinkContracted)) + " links")
+        return dfLinkContracted, self.linkChain
+
+    def solve_dfLink(self):
+        """
+        return the link table to be solved:
+        the contracted network if is_contract, otherwise dfLink
+        """
+        if self.is_contract and self.dfLinkContracted is not None:
+            return self.dfLinkContracted
+        return self.dfLink
+
+    def expand_chains(self, values):
+        """
+        return values of the links of the solved network (see solve_dfLink)
+        for each link in dfLink.
+        Flow is the same on all links of a chain.
+        """
+        values = np.asarray(values)
+        if self.is_contract and self.linkChain is not None:
+            return values[self.linkChain.values - 1]
+        return values
+
+    def build_spatial_index(self):
+        """
+        build the spatial index of the network:
+        KD-tree of node coordinates (projected to meter for geographic coordinates)
+        and KD-tree of the link segments (see mapmatching.MapMatching).
+        The index is kept in self.spatial_index and is built on the first spatial query;
+        call again after dfNode or dfLink is changed.
+        The cloud node is not indexed.
+        """
+        dfNode = self.dfNode
+        dfLink = self.dfLink
+        if self.cloud_node_id != "" and self.cloud_node_id is not None:
+            cloud = str(self.cloud_node_id)
+            dfNode = dfNode[dfNode.index.astype(str) != cloud]
+            dfLink = dfLink[(dfLink.Node1.astype(str) != cloud).values & (dfLink.Node2.astype(str) != cloud).values]
+        links = MapMatching(dfNode, dfLink)
+        x, y = links.project(dfNode.X.values.astype(float), dfNode.Y.values.astype(float))
+        self.spatial_index = {'nodeIds': dfNode.index.values,
+                              'nodeX': dfNode.X.values.astype(float),
+                              'nodeY': dfNode.Y.values.astype(float),
+                              'nodeTree': cKDTree(np.column_stack([x, y])),
+                              'links': links}
+        return self.spatial_index
+
+    def nodes_in_area(self, area):
+        """
+        return NodeIDs of the nodes inside area
+        area = bbox [xmin, ymin, xmax, ymax] or polygon [[x1, y1], [x2, y2], ...]
+        in the coordinates of dfNode
+        """
+        index = self.spatial_index or self.build_spatial_index()
+        area = np.asarray(area, dtype=float)
+        isPolygon = area.ndim == 2
+        if isPolygon:
+            xmin, ymin = area.min(axis=0)
+            xmax, ymax = area.max(axis=0)
+        else:
+            xmin, ymin, xmax, ymax = area
+        # candidates within the circle around the bbox, then exact test
+        px, py = index['links'].project(np.array([xmin, xmax]), np.array([ymin, ymax]))
+        center = [np.mean(px), np.mean(py)]
+        radius = np.hypot(px[1] - px[0], py[1] - py[0]) / 2
+        candidate = np.array(index['nodeTree'].query_ball_point(center, radius * (1 + 1e-9)), dtype=np.int64)
+        x, y = index['nodeX'][candidate], index['nodeY'][candidate]
+        isInside = (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+        if isPolygon and np.any(isInside):
+            isInside[isInside] = Path(area).contains_points(np.column_stack([x[isInside], y[isInside]]))
+        return index['nodeIds'][np.sort(candidate[isInside])]
+
+    def links_in_area(self, area, isCrossing=False):
+        """
+        return LinkIDs of the links with both nodes inside area (see nodes_in_area)
+        if isCrossing, also the links with one node inside (crossing the boundary of the area)
+        """
+        nodes = self.nodes_in_area(area)
+        isIn1 = self.dfLink.Node1.isin(nodes).values
+        isIn2 = self.dfLink.Node2.isin(nodes).values
+        isSelected = (isIn1 | isIn2) if isCrossing else (isIn1 & isIn2)
+        return self.dfLink.index.values[isSelected]
+
+    def nearest_nodes(self, x, y, k=1):
+        """
+        return NodeIDs of the k nearest nodes of each point (x, y)
+        and the distance (meter for geographic coordinates); N x k if k > 1
+        """
+        index = self.spatial_index or self.build_spatial_index()
+        px, py = index['links'].project(np.atleast_1d(x), np.atleast_1d(y))
+        distance, nearest = index['nodeTree'].query(np.column_stack([px, py]), k=k)
+        return index['nodeIds'][nearest], distance
+
+    def nearest_links(self, x, y, maxDistance=np.inf):
+        """
+        return LinkIDs of the nearest link of each point (x, y) and the distance to the link
+        (meter for geographic coordinates); the LinkID of a point farther than maxDistance is None
+        """
+        index = self.spatial_index or self.build_spatial_index()
+        links = index['links']
+        nearest, distance = links.nearestLink(x, y, maxDistance=maxDistance)
+        linkIds = links.dfLink.index.values.astype(object)[np.maximum(nearest, 0)]
+        linkIds[nearest < 0] = None
+        return linkIds, distance
+
+    def subnetwork(self, area, cloud_node_id=None, id=None):
+        """
+        return new Network of the nodes inside area (see nodes_in_area) and the links between them.
+        The links crossing the boundary of the area are kept (with the same LinkID)
+        but connected to a cloud node outside the area, such that the traffic
+        entering and leaving the area is kept in the sub-network.
+        cloud_node_id = NodeID of the cloud node
+            (default: max NodeID + 1 for numeric NodeIDs, otherwise 'cloud');
+            its coordinate is the mean of the boundary nodes.
+            The cloud node keeps the type of the NodeIDs in the node and link tables,
+            the cloud_node_id of the sub-network is its string (compared with str(NodeID))
+        """
+        nodes = self.nodes_in_area(area)
+        isIn1 = self.dfLink.Node1.isin(nodes).values
+        isIn2 = self.dfLink.Node2.isin(nodes).values
+        dfLink = self.dfLink[isIn1 | isIn2].copy()
+        isOut1, isOut2 = ~isIn1[isIn1 | isIn2], ~isIn2[isIn1 | isIn2]
+        dfNode = self.dfNode.loc[nodes].copy()
+        if np.any(isOut1) or np.any(isOut2):
+            isNumeric = np.issubdtype(self.dfNode.index.dtype, np.number)
+            if cloud_node_id is None:
+                cloud_node_id = self.dfNode.index.max() + 1 if isNumeric else 'cloud'
+            elif isNumeric:
+                cloud_node_id = int(cloud_node_id)  # e.g. "cloud": 78 or "78" in JSON
+            boundary = np.union1d(dfLink.Node1.values[isOut2], dfLink.Node2.values[isOut1])
+            dfLink.loc[isOut1, 'Node1'] = cloud_node_id
+            dfLink.loc[isOut2, 'Node2'] = cloud_node_id
+            dfNode.loc[cloud_node_id] = dfNode.loc[boundary].mean(numeric_only=True)
+            if not np.any(isOut1) or not np.any(isOut2):
+                print("warning: traffic only", "leaves" if np.any(isOut2) else "enters",
+                      "the area, the sub-network is not strongly connected.")
+        else:
+            cloud_node_id = ""
+        net = Network(id or self.id, {}, self.folder_path)
+        net.name = self.name
+        net.description = self.description
+        net.network_weight = self.network_weight
+        net.area = area
+        net.dfNode, net.dfLink, net.cloud_node_id = dfNode, dfLink, str(cloud_node_id)
+        print("sub-network: " + str(len(nodes)) + " nodes, " + str(len(dfLink)) + " links, " +
+              str(int(np.sum(isOut1 | isOut2))) + " boundary links")
+        return net
+
+    def load_graph(self, graph_file_name):
+        """
+        fill self.dfNode and self.dfLink directly from
+        osmnx graph file (graphml) or binary network cache (.npz)
+        """
+        import osm2ifn2  # osmnx is only needed for graph input
+        osm = osm2ifn2.OSM2IFN()
+        if graph_file_name.endswith('.npz'):
+            G = osm.loadNetworkCache(graph_file_name)
+        else:
+            G = osm.loadNetwork(graph_file_name)
+        self.dfNode, self.dfLink = osm.graph2ifn(G)
+
     def display_network(self, field='Capacity'):
         """
         display network based on field in self.dfLink
@@ -558,16 +2099,14 @@ class Network():
 
         maxFieldValue = max(self.dfLink[field])
         for index, row in self.dfNode.iterrows():
-            if self.cloud_node_id != index:
+            if str(self.cloud_node_id) != str(index):
                 x = row.X
                 y = row.Y
                 G.add_node(index, pos=(x, y))
-        for index, row in self.dfLink.iterrows():
-
-            node1 = row.Node1
-            node2 = row.Node2
-            if self.cloud_node_id != node1 and self.cloud_node_id != node2:
-                weight = (maxFieldValue - row[field]) * 100
+        # columns keep the type of NodeID (a row of iterrows may turn it into float)
+        for node1, node2, value in zip(self.dfLink.Node1.values, self.dfLink.Node2.values, self.dfLink[field].values):
+            if str(self.cloud_node_id) != str(node1) and str(self.cloud_node_id) != str(node2):
+                weight = (maxFieldValue - value) * 100
 
                 G.add_edge(node1, node2, weight=weight)
 